@@ -8,6 +8,7 @@ create table users (
     `name` varchar(50) not null,
     `image` varchar(500) not null,
     `created_at` real not null,
+    `token_gen` bigint not null default 0,
     unique key `idx_email` (`email`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
@@ -20,7 +21,7 @@ create table blogs (
     `user_image` varchar(500) not null,
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
-    `content` mediumtext not null,
+    `content` mediumblob not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
@@ -32,8 +33,30 @@ create table comments (
     `user_id` varchar(50) not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
-    `content` mediumtext not null,
+    `content` mediumblob not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
+);
+
+create table schema_migrations (
+    `version` varchar(20) not null,
+    `name` varchar(100) not null,
+    `applied_at` real not null,
+    primary key (`version`)
+);
+
+create table migration_checkpoints (
+    `name` varchar(100) not null,
+    `last_key` varchar(50) not null,
+    `rows` bigint not null,
+    `updated_at` real not null,
+    primary key (`name`)
+);
+
+create table table_versions (
+    `name` varchar(100) not null,
+    `version` bigint not null,
+    `updated_at` real not null,
+    primary key (`name`)
 );
\ No newline at end of file
@@ -0,0 +1,93 @@
+# -*- coding: UTF-8 -*-
+"""访问日志和异步日志输出：
+access_factory为每个请求记录一行JSON格式的访问日志，包含方法、路径、状态码、耗时、数据库耗时和响应的字节数；
+init_logging()把所有的日志放入队列，由QueueListener在后台线程中按各个handler的格式输出，事件循环中只需要合并消息并放入队列"""
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+from aiohttp import web
+try:
+    import orm
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+access_log = logging.getLogger('access')
+# 为False时不记录访问日志
+ACCESS_LOG = True
+_listener = None
+
+
+# 访问日志的字段通过extra放在record.fields中，输出为一行JSON
+# QueueHandler在放入队列之前已经合并了msg和args(参数之后被修改也不会影响日志)，并把args设为None
+class AccessFormatter(logging.Formatter):
+    def format(self, record):
+        fields = dict(time=self.formatTime(record, '%Y-%m-%dT%H:%M:%S'))
+        fields.update(record.fields)
+        return json.dumps(fields, ensure_ascii=False)
+
+
+def init_logging(configs):
+    """
+    Move the handlers of the root logger behind a queue and start the access log.
+    """
+    global ACCESS_LOG, _listener
+    if _listener is not None:
+        return
+    ACCESS_LOG = configs.get('access_log', True)
+    root = logging.getLogger()
+    root.setLevel(configs.get('log_level', 'INFO'))
+    handlers = root.handlers[:] or [logging.StreamHandler()]
+    for h in handlers:
+        root.removeHandler(h)
+        # 访问日志使用自己的格式
+        h.addFilter(lambda record: record.name != 'access')
+    filename = configs.get('access_log_file')
+    access_handler = logging.FileHandler(filename, encoding='utf-8') if filename else logging.StreamHandler()
+    access_handler.setFormatter(AccessFormatter())
+    access_handler.addFilter(lambda record: record.name == 'access')
+    q = queue.Queue(-1)
+    root.addHandler(logging.handlers.QueueHandler(q))
+    access_log.setLevel(logging.INFO)
+    _listener = logging.handlers.QueueListener(q, access_handler, *handlers, respect_handler_level=True)
+    _listener.start()
+    # 退出时输出队列中剩余的日志
+    atexit.register(_listener.stop)
+
+
+# 响应的字节数：已经输出的响应取实际输出的字节数，否则取body的长度
+def response_bytes(resp):
+    if resp.prepared:
+        return resp.body_length
+    body = getattr(resp, 'body', None)
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    return resp.content_length
+
+
+# 放在所有中间件的最前面，统计整个请求的耗时
+# 路由的log选项只控制logger_factory的DEBUG日志，访问日志记录所有的请求，包括静态文件和404、405
+async def access_factory(app, handler):
+    async def access(request):
+        if not ACCESS_LOG:
+            return (await handler(request))
+        start = time.perf_counter()
+        stats = [0.0, 0]
+        orm.db_stats.set(stats)
+        status = 500
+        resp = None
+        try:
+            resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            access_log.info('%s %s %s', request.method, request.path_qs, status, extra=dict(fields=dict(
+                method=request.method, path=request.path_qs, status=status,
+                ms=round((time.perf_counter() - start) * 1000, 2), db_ms=round(stats[0] * 1000, 2), db_queries=stats[1],
+                bytes=response_bytes(resp) if resp is not None else None)))
+    return access
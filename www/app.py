@@ -5,33 +5,69 @@ import asyncio
 from aiohttp import web
 try:
     from requestHandler import add_routes, logger_factory, response_factory, auth_factory
-    from requestHandler import init__jinja2, add_static, datetime_filter
-    import orm, config
+    from requestHandler import init__jinja2, add_static, datetime_filter, init_render, watch_render
+    from requestHandler import init_session
+    import orm, config, archive, dbtrace, serializer, compression, assets, accesslog
 except ImportError:
     raise ImportError('The file is not found. Please check the file name!')
 
 logging.basicConfig(level=logging.INFO)
 
-async def init(loop):
-    kw = config.configs
-    await orm.create_pool(loop=loop, **kw)
+# 创建Web App，注册中间件、模板、URL处理函数和静态文件
+def make_app(loop):
     # middlewares(中间件)设置2个中间处理函数(都是装饰器)
     # middlewares中的每个factory接受两个参数，app 和 handler(即middlewares中的下一个handler)
     # 譬如这里logger_factory的handler参数其实就是response_factory
     # middlewares的最后一个元素的handler会通过routes查找到相应的，就是routes注册的对应handler处理函数
     # 这是装饰模式的体现，logger_factory, response_factory都是URL处理函数前（如handler.index）的装饰功能
-    app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
-    init__jinja2(app, filters=dict(datetime=datetime_filter))  # 定义时间过滤器
+    # compression_factory压缩response_factory生成的响应，静态文件请求直接返回预压缩的文件
+    # static_factory为带hash的静态文件设置永久缓存，access_factory记录每个请求的访问日志
+    app = web.Application(loop=loop, middlewares=[
+        accesslog.access_factory, logger_factory, assets.static_factory, compression.compression_factory,
+        auth_factory, response_factory])
+    # 定义时间过滤器，模板中通过static_url()和bundle_urls()引用静态文件
+    # 生产模式下关闭auto_reload，使用字节码缓存并预编译所有模板
+    production = not config.configs.debug
+    init__jinja2(app, filters=dict(datetime=datetime_filter), globals=dict(
+        static_url=assets.static_url, bundle_urls=assets.bundle_urls),
+        auto_reload=not production, bytecode_cache=production,
+        bytecode_cache_dir=config.configs.template_cache_dir, precompile=production)
     # 添加URL处理函数
     add_routes(app, 'handlers')
     # 添加CSS等静态文件路径
     add_static(app)
+    return app
+
+async def init(loop):
+    kw = config.configs
+    # 日志在后台线程中输出
+    accesslog.init_logging(kw)
+    serializer.use(kw.json_serializer)
+    compression.init_compression(kw)
+    init_render(kw)
+    init_session(kw)
+    # 生成带hash的静态文件，然后为静态文件生成.gz和.br文件
+    assets.build_assets()
+    compression.precompress_static()
+    # 按配置录制或者回放数据库查询，回放时不连接数据库
+    dbtrace.init_trace(kw)
+    await orm.create_pool(loop=loop, **kw)
+    # 压缩字段的列变成blob之后才压缩保存
+    await orm.load_column_types()
+    loop.create_task(orm.watch_column_types())
+    # 读取已有的评论归档表，查询评论时会同时查询这些表
+    await archive.load_all_archive_tables()
+    loop.create_task(archive.watch_archive_tables())
+    # 定时记录模板渲染的耗时、事件循环被阻塞的最长时间和会话缓存的命中率
+    loop.create_task(watch_render())
+    app = make_app(loop)
     srv = await loop.create_server(app.make_handler(), '127.0.0.1', 8000)
     logging.info('Server started at http://127.0.0.1:8000')
     return srv
 
-# 获取eventloop
-loop = asyncio.get_event_loop()
-# 然后加入运行事件
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    # 获取eventloop
+    loop = asyncio.get_event_loop()
+    # 然后加入运行事件
+    loop.run_until_complete(init(loop))
+    loop.run_forever()
@@ -0,0 +1,131 @@
+# -*- coding: UTF-8 -*-
+"""按月归档评论：将较早的评论分批移动到comments_YYYYMM归档表中，主表和它的索引保持较小的规模。
+归档之后Comment的查询会通过orm自动同时查询主表和归档表。"""
+import sys
+import time
+import asyncio
+import logging
+try:
+    import orm
+    from config import configs
+    from migrate import backfill
+    from models import Comment
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+# 需要按月归档的Model
+ARCHIVED_MODELS = (Comment,)
+# 默认归档多少个月之前的评论
+ARCHIVE_MONTHS = 6
+# 每批移动的行数
+ARCHIVE_BATCH_SIZE = 500
+# Web App中重新读取归档表的间隔(秒)，归档由单独的进程执行，新建的归档表需要被Web App发现
+# 归档前新建归档表之后会等待两个间隔，再开始移动评论
+ARCHIVE_RELOAD_INTERVAL = 60
+
+
+# 归档表名：表名_年月，如comments_201801
+def archive_table_name(model, t):
+    return '%s_%s' % (model.__table__, time.strftime('%Y%m', time.localtime(t)))
+
+
+# 从数据库中读取已有的归档表，填入Model的__archive_tables__，按月份从新到旧排列
+async def load_archive_tables(model):
+    rs = await orm.select("show tables like '%s\\_______'" % model.__table__, [])
+    tables = [t for r in rs for t in r.values() if t[-6:].isdigit()]
+    tables.sort(reverse=True)
+    model.__archive_tables__[:] = tables
+    logging.info('found archive tables of %s: %s' % (model.__table__, ', '.join(tables) or 'none'))
+    return tables
+
+
+async def load_all_archive_tables():
+    for model in ARCHIVED_MODELS:
+        await load_archive_tables(model)
+
+
+# 定时重新读取归档表
+async def watch_archive_tables(interval=ARCHIVE_RELOAD_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await load_all_archive_tables()
+        except Exception as e:
+            logging.exception(e)
+
+
+# 第months个月之前的月初的时间戳
+def months_ago(months):
+    t = time.localtime()
+    year, month = t.tm_year, t.tm_mon - months
+    while month < 1:
+        year -= 1
+        month += 12
+    return time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1))
+
+
+# 主表中早于before的行所在的每个月份的归档表名
+async def pending_archive_tables(model, before):
+    rs = await orm.select('select min(`created_at`) as `t` from `%s` where `created_at`<?' % model.__table__, [before])
+    t = rs[0]['t'] if rs else None
+    names = []
+    while t is not None and t < before:
+        names.append(archive_table_name(model, t))
+        tm = time.localtime(t)
+        # 下个月的月初，mktime会把13月转换成下一年的1月
+        t = time.mktime((tm.tm_year, tm.tm_mon + 1, 1, 0, 0, 0, 0, 0, -1))
+    return names
+
+
+async def archive(model, before, wait=ARCHIVE_RELOAD_INTERVAL * 2):
+    """
+    Move rows created before timestamp before into monthly archive tables, in batches.
+    Rows are copied by insert ignore and then deleted, so an interrupted run can be repeated safely.
+    """
+    table = model.__table__
+    pk = model.__primary_key__
+    created = set(model.__archive_tables__)
+    # 移动任何行之前先建好需要的归档表，等Web App重新读取归档表之后再移动，归档的行在读取时不会暂时消失
+    new = [name for name in await pending_archive_tables(model, before) if name not in created]
+    for name in new:
+        await orm.execute('create table if not exists `%s` like `%s`' % (name, table), [])
+        created.add(name)
+    if new and wait:
+        logging.info('created archive tables %s, wait %s seconds for the web app to load them...'
+                     % (', '.join(new), wait))
+        await asyncio.sleep(wait)
+
+    async def move(rows):
+        months = dict()
+        for r in rows:
+            months.setdefault(archive_table_name(model, r['created_at']), []).append(r[pk])
+        for name, ids in months.items():
+            if name not in created:
+                await orm.execute('create table if not exists `%s` like `%s`' % (name, table), [])
+                created.add(name)
+            await orm.execute('insert ignore into `%s` select * from `%s` where `%s` in (%s)' % (
+                name, table, pk, orm.create_args_string(len(ids))), ids)
+            await orm.execute('delete from `%s` where `%s` in (%s)' % (
+                table, pk, orm.create_args_string(len(ids))), ids)
+
+    rows = await backfill('archive_%s_%d' % (table, before), model, move, fields=['created_at'],
+                          where='`created_at`<?', args=[before], batch_size=ARCHIVE_BATCH_SIZE)
+    model.__archive_tables__[:] = sorted(created, reverse=True)
+    logging.info('archived %s rows of %s before %s' % (rows, table, time.strftime('%Y-%m-%d', time.localtime(before))))
+    return rows
+
+
+async def main(loop, months):
+    await orm.create_pool(loop=loop, **configs)
+    await load_all_archive_tables()
+    for model in ARCHIVED_MODELS:
+        await archive(model, months_ago(months))
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if argv and not argv[0].isdigit():
+        print('Usage: python archive.py [months]')
+        exit(0)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, int(argv[0]) if argv else ARCHIVE_MONTHS))
@@ -0,0 +1,198 @@
+# -*- coding: UTF-8 -*-
+"""静态文件指纹：build_assets()按内容计算static中每个文件的hash，
+把文件复制为static/dist中文件名带有hash的文件(如css/uikit.min.1a2b3c4d5e.css)，CSS中引用的字体和图片也改为带hash的文件名。
+模板中使用static_url('css/uikit.min.css')生成带hash的URL，文件内容不变时URL不变，浏览器可以一直使用缓存。
+同时把BUNDLES中每种页面用到的CSS和JS文件合并(项目自己的文件先压缩)成一个文件，模板中使用bundle_urls()引用。
+用法：python assets.py  生成static/dist"""
+import os
+import re
+import json
+import hashlib
+import logging
+import posixpath
+
+STATIC_PREFIX = '/static/'
+STATIC_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+# 带hash的文件所在的目录，相对于static
+DIST_DIR = 'dist'
+DIST_PREFIX = STATIC_PREFIX + DIST_DIR + '/'
+# 文件名中hash的长度
+HASH_LENGTH = 10
+# 带hash的URL的内容不会改变，浏览器缓存一年，并且不需要验证
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_RE_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+_RE_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_RE_CSS_SPACE = re.compile(r'\s*([{};,>])\s*')
+
+# 每种页面合并的文件，合并后的文件名 => 按顺序合并的文件，文件名都相对于static
+# 合并后的CSS和原来的CSS在同一个目录中，CSS中引用字体和图片的相对路径不变
+BUNDLES = {
+    'css/base.bundle.css': ('css/uikit.min.css', 'css/uikit.gradient.min.css', 'css/awesome.css'),
+    'js/base.bundle.js': ('js/jquery.min.js', 'js/sha1.min.js', 'js/vue.min.js', 'js/sticky.min.js',
+                          'js/uikit.min.js', 'js/awesome.js'),
+    'css/signin.bundle.css': ('css/uikit.min.css', 'css/uikit.gradient.min.css'),
+    'js/signin.bundle.js': ('js/jquery.min.js', 'js/sha1.min.js', 'js/uikit.min.js', 'js/vue.min.js',
+                            'js/awesome.js'),
+}
+
+# 相对static的路径 => 相对static/dist的带hash的路径
+_manifest = dict()
+
+
+def hashed_name(rel, data):
+    base, ext = posixpath.splitext(rel)
+    return '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:HASH_LENGTH], ext)
+
+
+# 将CSS中url()引用的static中的文件替换为带hash的文件，保留?和#后面的部分
+def rewrite_css(rel, data, manifest):
+    directory = posixpath.dirname(rel)
+
+    def replace(m):
+        quote, url = m.group(1), m.group(2)
+        if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return m.group(0)
+        n = min([i for i in (url.find('?'), url.find('#')) if i >= 0] or [len(url)])
+        path, suffix = url[:n], url[n:]
+        target = manifest.get(posixpath.normpath(posixpath.join(directory, path)))
+        if target is None:
+            return m.group(0)
+        return 'url(%s%s%s%s)' % (quote, posixpath.relpath(target, directory), suffix, quote)
+    return _RE_CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+# 压缩CSS：去掉注释和多余的空白
+def minify_css(text):
+    text = _RE_CSS_COMMENT.sub('', text)
+    text = _RE_CSS_SPACE.sub(r'\1', text)
+    return ' '.join(text.split())
+
+
+# 压缩JS：没有JS的语法分析，只去掉每行首尾的空白、空行和整行的//注释，不改变任何语句
+def minify_js(text):
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+# 合并sources中的文件，已经压缩过的.min文件直接合并
+def bundle(root, rel, sources):
+    css = rel.endswith('.css')
+    parts = []
+    for source in sources:
+        with open(os.path.join(root, source), 'r', encoding='utf-8') as f:
+            text = f.read()
+        if '.min.' not in source:
+            text = minify_css(text) if css else minify_js(text)
+        parts.append(text.strip())
+    # JS文件之间加上分号，避免前一个文件的最后一条语句没有分号
+    return ('\n' if css else ';\n').join(parts).encode('utf-8')
+
+
+def build_assets(root=None):
+    """
+    Copy files in root to root/dist with content hashes in their names, return the manifest.
+    """
+    if root is None:
+        root = STATIC_ROOT
+    dist = os.path.join(root, DIST_DIR)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root and DIST_DIR in dirnames:
+            dirnames.remove(DIST_DIR)
+        for filename in filenames:
+            # 跳过compression.py生成的预压缩文件
+            if filename.endswith(('.gz', '.br')):
+                continue
+            files.append(os.path.relpath(os.path.join(dirpath, filename), root).replace(os.sep, '/'))
+    # CSS中引用了其他文件，最后处理，合并的文件只在内存中生成
+    files.sort(key=lambda rel: rel.endswith('.css'))
+    files.extend(sorted(BUNDLES.keys(), key=lambda rel: rel.endswith('.css')))
+    manifest = dict()
+    written = 0
+    for rel in files:
+        if rel in BUNDLES:
+            data = bundle(root, rel, BUNDLES[rel])
+        else:
+            with open(os.path.join(root, rel), 'rb') as f:
+                data = f.read()
+        if rel.endswith('.css'):
+            data = rewrite_css(rel, data, manifest)
+        manifest[rel] = hashed_name(rel, data)
+        target = os.path.join(dist, manifest[rel])
+        # 文件名由内容决定，已经存在的文件不需要重新写入
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            written += 1
+    with open(os.path.join(dist, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    removed = remove_stale(dist, manifest)
+    _manifest.clear()
+    _manifest.update(manifest)
+    logging.info('static assets: %s, written: %s, removed: %s' % (len(manifest), written, removed))
+    return manifest
+
+
+# 删除dist中不在manifest中的文件(以前生成的旧版本)以及它们预压缩的.gz和.br文件，返回删除的文件数
+def remove_stale(dist, manifest):
+    keep = set(manifest.values())
+    keep.add('manifest.json')
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(dist, topdown=False):
+        for filename in filenames:
+            rel = os.path.relpath(os.path.join(dirpath, filename), dist).replace(os.sep, '/')
+            if rel.endswith(('.gz', '.br')):
+                rel = rel[:-3]
+            if rel not in keep:
+                os.remove(os.path.join(dirpath, filename))
+                removed += 1
+        if dirpath != dist and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    return removed
+
+
+def static_url(rel):
+    """
+    URL of static file rel, with a content hash in its name if build_assets() has been run.
+    """
+    hashed = _manifest.get(rel)
+    if hashed is None:
+        return STATIC_PREFIX + rel
+    return DIST_PREFIX + hashed
+
+
+def bundle_urls(rel):
+    """
+    URLs to include for bundle rel: the bundled file after build_assets(), otherwise the files it is built from.
+    """
+    if rel in _manifest:
+        return [DIST_PREFIX + _manifest[rel]]
+    return [static_url(source) for source in BUNDLES[rel]]
+
+
+def manifest_hash():
+    """
+    Hash of the current manifest, it changes when any of the static files changes.
+    """
+    return hashlib.md5(json.dumps(_manifest, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# 为带hash的静态文件设置永久缓存的响应头，放在compression_factory之前，预压缩的文件也会设置
+async def static_factory(app, handler):
+    async def static(request):
+        resp = await handler(request)
+        if request.path.startswith(DIST_PREFIX) and resp.status == 200:
+            resp.headers['Cache-Control'] = IMMUTABLE
+        return resp
+    return static
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print('%s files in manifest.' % len(build_assets()))
@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+"""测量框架处理每个请求的开销：比较通过RequestHandler调用URL处理函数和直接调用URL处理函数的耗时。
+用法：python bench_handler.py [iterations]"""
+import sys
+import time
+import asyncio
+import logging
+from aiohttp.test_utils import make_mocked_request
+try:
+    from requestHandler import RequestHandler, get
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+ITERATIONS = 100000
+
+
+@get('/')
+async def no_args():
+    return 'ok'
+
+
+@get('/signout')
+async def request_only(request):
+    return 'ok'
+
+
+@get('/blog/{id}')
+async def path_arg(id, request):
+    return 'ok'
+
+
+@get('/api/blogs')
+async def query_args(*, page='1'):
+    return 'ok'
+
+
+# (URL处理函数, 请求的URL, URL中的参数, 直接调用时的参数)
+CASES = (
+    (no_args, '/', {}, {}),
+    (request_only, '/signout', {}, {'request': None}),
+    (path_arg, '/blog/1', {'id': '1'}, {'id': '1', 'request': None}),
+    (query_args, '/api/blogs?page=2', {}, {'page': '2'}),
+)
+
+
+async def measure(fn, arg, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        await fn(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+async def run(iterations):
+    for fn, url, match_info, kw in CASES:
+        request = make_mocked_request('GET', url, match_info=match_info)
+        handler = RequestHandler(None, fn, fn.__route__)
+        if 'request' in kw:
+            kw = dict(kw, request=request)
+        framework_us = await measure(handler, request, iterations)
+        direct_us = await measure(lambda r: fn(**kw), request, iterations)
+        print('%-14s %-20s handler %7.2fus  direct %7.2fus  overhead %7.2fus'
+              % (fn.__name__, url, framework_us, direct_us, framework_us - direct_us))
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if argv and not argv[0].isdigit():
+        print('Usage: python bench_handler.py [iterations]')
+        exit(0)
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(int(argv[0]) if argv else ITERATIONS))
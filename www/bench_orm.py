@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 -*-
+"""ORM开销的基准测试：分别通过Model的方法和直接调用数据库驱动执行相同的SQL，比较两者的耗时。
+后端可以是stub(内存中直接返回结果，只测量ORM本身)或者sqlite(标准库的sqlite3内存数据库)。
+结果以JSON格式写入文件，便于比较不同版本的结果。
+用法：python bench_orm.py [stub|sqlite] [output.json]"""
+import sys
+import re
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import platform
+try:
+    import orm
+    from models import Blog, next_id
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+# 每个测试项执行的次数
+ITERATIONS = 2000
+# 每个测试项正式计时之前预热执行的次数
+WARMUP = 10
+# findAll测试的结果行数
+FINDALL_SIZES = (1, 10, 100, 1000)
+
+
+def make_rows(n):
+    field = Blog.__mappings__['content']
+    return [dict(id='%050d' % i, user_id='u', user_name='name', user_image='about:blank', name='blog %s' % i,
+                 summary='summary', content=field.compress('content %s ' % i * 100), created_at=time.time())
+            for i in range(n)]
+
+
+# 不访问数据库，直接返回预先生成的结果
+class StubBackend(object):
+    name = 'stub'
+
+    def __init__(self):
+        self.all_rows = make_rows(max(FINDALL_SIZES))
+        self.rows = self.all_rows
+
+    def limit(self, n):
+        self.rows = self.all_rows[:n]
+
+    async def select(self, sql, args, size=None):
+        if '_num_' in sql:
+            return [dict(_num_=len(self.all_rows))]
+        return self.rows[:size] if size else self.rows
+
+    async def execute(self, sql, args):
+        return 1
+
+
+# MySQL的 on duplicate key update 子句
+_RE_UPSERT = re.compile(r'^insert into `(\w+)`(.*) on duplicate key update (.*)$', re.S)
+
+
+# 使用sqlite3的内存数据库，SQL语句中的?占位符和`引号sqlite都支持，
+# orm.touch()等语句中MySQL的 on duplicate key update 改写成sqlite的 on conflict (主键) do update set
+class SqliteBackend(object):
+    name = 'sqlite'
+    primary_keys = {Blog.__table__: Blog.__primary_key__, orm.VERSION_TABLE: 'name'}
+
+    def __init__(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.row_factory = lambda cur, row: dict(zip([c[0] for c in cur.description], row))
+        columns = ', '.join('`%s`' % f for f in [Blog.__primary_key__] + Blog.__fields__)
+        self.conn.execute('create table `blogs` (%s, primary key (`id`))' % columns)
+        self.conn.execute('create index `idx_created_at` on `blogs` (`created_at`)')
+        self.conn.execute('create table `%s` (`name` not null, `version` not null, `updated_at` not null, '
+                          'primary key (`name`))' % orm.VERSION_TABLE)
+        rows = make_rows(max(FINDALL_SIZES))
+        self.conn.executemany('insert into `blogs` (%s) values (%s)' % (
+            ', '.join('`%s`' % k for k in rows[0].keys()), orm.create_args_string(len(rows[0]))),
+            [list(r.values()) for r in rows])
+
+    # 行数由SQL语句中的limit决定
+    def limit(self, n):
+        pass
+
+    async def select(self, sql, args, size=None):
+        cur = self.conn.execute(sql, args or ())
+        rs = cur.fetchmany(size) if size else cur.fetchall()
+        cur.close()
+        return rs
+
+    def translate(self, sql):
+        m = _RE_UPSERT.match(sql)
+        if m is None:
+            return sql
+        table, insert, update = m.groups()
+        return 'insert into `%s`%s on conflict (`%s`) do update set %s' % (
+            table, insert, self.primary_keys[table], re.sub(r'values\((`\w+`)\)', r'excluded.\1', update))
+
+    async def execute(self, sql, args):
+        cur = self.conn.execute(self.translate(sql), args)
+        affected = cur.rowcount
+        cur.close()
+        return affected
+
+
+async def measure(fn, iterations):
+    # 先预热，避免第一次执行的开销计入结果
+    for i in range(WARMUP):
+        await fn()
+    start = time.perf_counter()
+    for i in range(iterations):
+        await fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+async def run(backend, iterations=ITERATIONS):
+    orm.select = backend.select
+    orm.execute = backend.execute
+    # 两种后端中content都按blob保存，和迁移之后一样计入压缩的开销
+    Blog.__mappings__['content'].binary = True
+    raw_select, raw_execute = backend.select, backend.execute
+    results = dict()
+
+    async def case(name, orm_fn, raw_fn, n=iterations):
+        orm_us = await measure(orm_fn, n)
+        raw_us = await measure(raw_fn, n)
+        results[name] = dict(orm_us=round(orm_us, 2), raw_us=round(raw_us, 2), overhead_us=round(orm_us - raw_us, 2))
+        print('%-16s orm %10.2fus  raw %10.2fus  overhead %10.2fus' % (name, orm_us, raw_us, orm_us - raw_us))
+
+    pk = (await raw_select(Blog.__select__ + ' limit 1', []))[0]['id']
+    find_sql = '%s where `%s`= ?' % (Blog.__select__, Blog.__primary_key__)
+    await case('find', lambda: Blog.find(pk), lambda: raw_select(find_sql, [pk], 1))
+
+    for size in FINDALL_SIZES:
+        backend.limit(size)
+        sql = '%s order by created_at desc limit ?' % Blog.__select__
+        await case('findAll[%s]' % size, lambda: Blog.findAll(orderBy='created_at desc', limit=size),
+                   lambda: raw_select(sql, [size]), max(10, iterations // size))
+
+    await case('findNumber', lambda: Blog.findNumber('count(id)'),
+               lambda: raw_select('select count(id) _num_ from `blogs` ', None, 1))
+
+    # 每次save都需要新的主键，预先生成，raw使用相同的参数
+    n = iterations + WARMUP
+    blogs = [Blog(user_id='u', user_name='name', user_image='about:blank', name='new', summary='summary',
+                  content='content ' * 100) for i in range(n * 2)]
+    raw_args = [b._insertArgs() for b in blogs[n:]]
+    for b in blogs[:n]:
+        b.id = next_id()
+    orm_blogs, raw_blogs = iter(blogs[:n]), iter(raw_args)
+    await case('save', lambda: next(orm_blogs).save(), lambda: raw_execute(Blog.__insert__, next(raw_blogs)))
+
+    blog = await Blog.find(pk)
+    update_args = blog._compressArgs(list(map(blog.getValue, Blog.__fields__)) + [pk])
+    await case('update', lambda: blog.update(), lambda: raw_execute(Blog.__update__, update_args))
+
+    orm_blogs, raw_blogs = iter(blogs[:n]), iter(raw_args)
+    await case('remove', lambda: next(orm_blogs).remove(),
+               lambda: raw_execute(Blog.__delete__, [next(raw_blogs)[-1]]))
+
+    # 单独测量构造对象和取默认值的开销
+    row = backend.all_rows[0] if isinstance(backend, StubBackend) else (await raw_select(find_sql, [pk], 1))[0]
+
+    async def construct():
+        Blog(**row)
+
+    async def construct_raw():
+        dict(row)
+    await case('cls(**r)', construct, construct_raw, iterations * 10)
+
+    new_blog = Blog()
+
+    async def defaults():
+        new_blog.id = None
+        new_blog.getValueOrDefault('id')
+
+    async def defaults_raw():
+        next_id()
+    await case('getValueOrDefault', defaults, defaults_raw, iterations * 10)
+    return results
+
+
+def main(backend_name, output):
+    # 关闭INFO日志的输出，但格式化日志字符串的开销仍然会计入
+    logging.getLogger().setLevel(logging.WARNING)
+    backend = SqliteBackend() if backend_name == 'sqlite' else StubBackend()
+    results = asyncio.get_event_loop().run_until_complete(run(backend))
+    report = dict(time=time.strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(),
+                  backend=backend.name, iterations=ITERATIONS, results=results)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print('results written to %s' % output)
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if len(argv) > 2 or (argv and argv[0] not in ('stub', 'sqlite')):
+        print('Usage: python bench_orm.py [stub|sqlite] [output.json]')
+        exit(0)
+    main(argv[0] if argv else 'stub', argv[1] if len(argv) > 1 else 'bench_orm.json')
@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+"""将blogs和comments表的content列迁移为压缩存储(见migrations/0001_compress_content.py)，
+直接运行时统计每次访问/blog/{id}读取的字节数"""
+import sys
+import asyncio
+import logging
+try:
+    import orm
+    from config import configs
+    from migrate import backfill
+    from models import Blog
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+
+# content列的在线迁移，每一步都可以中断后重新运行，从information_schema中的列判断进行到了哪一步：
+# 1. 增加可以为null的blob列content_z(algorithm=inplace)，用触发器让写入content的行同时写入content_z；
+# 2. 通过migrate.backfill()按主键顺序分批把content压缩到content_z中，中断后从上次的进度继续；
+# 3. 锁表删除触发器，把content改名为content_old，content_z改名为content，只修改元数据，锁表的时间很短；
+# 4. 删除content_old。
+# 除了第3步，迁移过程中表都可以正常读写
+async def _columns(model):
+    rs = await orm.select('select `column_name` as `column_name`, `column_type` as `column_type` '
+                          'from information_schema.columns where `table_schema`=database() and `table_name`=? '
+                          'and `column_name` in (?, ?, ?)', [model.__table__, 'content', 'content_z', 'content_old'])
+    return dict((r['column_name'], r['column_type'].lower()) for r in rs)
+
+
+async def migrate(model):
+    field = model.__mappings__['content']
+    table = model.__table__
+    pk = model.__primary_key__
+    triggers = ['%s_content_z_%s' % (table, event) for event in ('insert', 'update')]
+    columns = await _columns(model)
+    rows = 0
+    if 'content_old' not in columns:
+        if 'content_z' not in columns:
+            # 已经是blob的表(如用schema.sql新建的)不需要迁移
+            if columns.get('content', field.column_type) == field.column_type:
+                return 0
+            # content改成可以为null，改名为content_old之后新插入的行不会再写入这一列
+            await orm.execute('alter table `%s` modify `content` %s null, add column `content_z` %s null, '
+                              'algorithm=inplace, lock=none' % (table, columns['content'], field.column_type), [])
+        for name, event in zip(triggers, ('insert', 'update')):
+            await orm.execute('drop trigger if exists `%s`' % name, [])
+            # 触发器写入的是未压缩的文本，第0个字节为PLAIN标记
+            await orm.execute('create trigger `%s` before %s on `%s` for each row '
+                              'set new.`content_z`=concat(0x00, convert(new.`content` using utf8mb4))'
+                              % (name, event, table), [])
+
+        async def compress(rows):
+            values = [(r[pk], field.compress(field.decompress(r['content']))) for r in rows]
+            # 每批只执行一条 update ... set `content_z`=case `id` when ? then ? ... end 语句，
+            # 查询之后被修改过的行已经由触发器写入了content_z，不能覆盖
+            args = [a for v in values for a in v] + [v[0] for v in values]
+            await orm.execute('update `%s` set `content_z`=case `%s`%s end where `%s` in (%s) and `content_z` is null' % (
+                table, pk, ' when ? then ?' * len(values), pk, orm.create_args_string(len(values))), args)
+
+        rows = await backfill('compress_%s_content' % table, model, compress, fields=['content'], where='`content_z` is null')
+        logging.info('%s: rename `content_z` to `content`...' % table)
+        # 删除触发器和改名必须在锁表期间完成，否则两者之间写入的content不会进入content_z
+        await orm.execute_locked([table], ['drop trigger if exists `%s`' % name for name in triggers] + [
+            'alter table `%s` change `content` `content_old` %s null, change `content_z` `content` %s null, '
+            'algorithm=inplace' % (table, columns['content'], field.column_type)])
+    logging.info('%s: drop `content_old`...' % table)
+    await orm.execute('alter table `%s` drop column `content_old`, modify `content` %s not null, '
+                      'algorithm=inplace, lock=none' % (table, field.column_type), [])
+    # 列已经是blob，当前进程之后写入的content都会压缩，其它进程会在orm.watch_column_types()重新读取列类型后开始压缩
+    await orm.load_column_types(model)
+    return rows
+
+
+# 统计每次访问/blog/{id}时从数据库读取的content字节数(压缩后)以及解压后的字节数
+async def bench(limit=100):
+    blogs = await orm.select('select `id`, `content` from `blogs` order by `created_at` desc limit ?', [limit])
+    stored = 0
+    raw = 0
+    for b in blogs:
+        rows = [b] + await orm.select('select `content` from `comments` where `blog_id`=?', [b['id']])
+        for r in rows:
+            content = r['content']
+            stored += len(content.encode('utf-8') if isinstance(content, str) else content)
+            raw += len(Blog.__mappings__['content'].decompress(content).encode('utf-8'))
+    n = len(blogs) or 1
+    print('blogs: %s' % len(blogs))
+    print('bytes read per /blog/{id}: %.0f (uncompressed: %.0f, ratio: %.2f)'
+          % (stored / n, raw / n, stored / raw if raw else 1.0))
+
+
+async def main(loop):
+    await orm.create_pool(loop=loop, **configs)
+    await bench()
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if argv:
+        print('Usage: python compress_content.py')
+        exit(0)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+"""响应压缩：
+compression_factory根据Accept-Encoding选择brotli或者gzip压缩响应，有ETag的响应会缓存压缩后的结果；
+precompress_static()预先把static中的文件压缩成.gz和.br文件，请求静态文件时直接返回压缩好的文件。
+用法：python compression.py  预先压缩www/static中的文件"""
+import os
+import gzip
+import logging
+import mimetypes
+from collections import OrderedDict
+from aiohttp import web
+
+# brotli是可选的，没有安装时只使用gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 小于这个字节数的响应不压缩
+COMPRESS_MIN_SIZE = 1024
+# 动态响应的压缩级别，预压缩静态文件时使用最高的级别
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# 缓存的压缩结果的最大个数
+COMPRESS_CACHE_SIZE = 256
+# 需要压缩的响应类型和静态文件的扩展名，图片和woff字体本身已经压缩过
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+                      'application/vnd.ms-fontobject', 'application/x-font-ttf', 'font/ttf', 'font/otf')
+COMPRESSIBLE_EXTS = ('.js', '.css', '.html', '.json', '.svg', '.txt', '.eot', '.ttf', '.otf')
+
+STATIC_PREFIX = '/static/'
+STATIC_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# 预压缩的静态文件，相对static的路径 => 已经生成的压缩格式
+_precompressed = dict()
+# (URL, ETag, 压缩格式) => 压缩后的bytes
+_cache = OrderedDict()
+
+
+def init_compression(configs):
+    global COMPRESS_MIN_SIZE, GZIP_LEVEL, BROTLI_QUALITY
+    COMPRESS_MIN_SIZE = configs.get('compress_min_size', COMPRESS_MIN_SIZE)
+    GZIP_LEVEL = configs.get('gzip_level', GZIP_LEVEL)
+    BROTLI_QUALITY = configs.get('brotli_quality', BROTLI_QUALITY)
+
+
+# 服务器支持的压缩格式，排在前面的优先
+def supported():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+# 解析Accept-Encoding，按照q值从大到小返回客户端接受的压缩格式，q值相同时按服务器的偏好排序
+def accepted(accept_encoding):
+    if not accept_encoding:
+        return []
+    prefs = dict()
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        name = name.strip().lower()
+        if name == '*':
+            for e in ('br', 'gzip'):
+                prefs.setdefault(e, q)
+        elif name in ('br', 'gzip'):
+            prefs[name] = q
+    order = ('br', 'gzip')
+    return sorted((e for e, q in prefs.items() if q > 0), key=lambda e: (-prefs[e], order.index(e)))
+
+
+def compress(data, encoding, static=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if static else BROTLI_QUALITY)
+    # mtime=0使相同的内容生成相同的结果
+    return gzip.compress(data, compresslevel=9 if static else GZIP_LEVEL, mtime=0)
+
+
+def compressible(content_type):
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+# 在Vary中添加name，保留已有的值(如条件GET设置的Cookie)
+def add_vary(resp, name):
+    vary = resp.headers.get('Vary')
+    if not vary:
+        resp.headers['Vary'] = name
+    elif name.lower() not in vary.lower():
+        resp.headers['Vary'] = '%s, %s' % (vary, name)
+
+
+def precompress_static(root=None):
+    """
+    Write .gz (and .br if brotli is installed) next to every compressible file in root, return files written.
+    """
+    if root is None:
+        root = STATIC_ROOT
+    encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+    written = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.endswith(COMPRESSIBLE_EXTS):
+                continue
+            path = os.path.join(dirpath, filename)
+            if os.path.getsize(path) < COMPRESS_MIN_SIZE:
+                continue
+            rel = os.path.relpath(path, root).replace(os.sep, '/')
+            data = None
+            for encoding in encodings:
+                target = path + ('.br' if encoding == 'br' else '.gz')
+                # 源文件没有修改时不重新压缩
+                if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(path):
+                    if data is None:
+                        with open(path, 'rb') as f:
+                            data = f.read()
+                    with open(target, 'wb') as f:
+                        f.write(compress(data, encoding, True))
+                    written += 1
+                _precompressed.setdefault(rel, set()).add(encoding)
+    logging.info('precompressed static files: %s, written: %s' % (len(_precompressed), written))
+    return written
+
+
+# 客户端接受的格式有预压缩的文件时，返回这个文件，否则返回None
+def static_response(rel, encodings, root=None):
+    available = _precompressed.get(rel)
+    if not available:
+        return None
+    for encoding in encodings:
+        if encoding in available:
+            path = os.path.join(root or STATIC_ROOT, rel)
+            resp = web.FileResponse(path + ('.br' if encoding == 'br' else '.gz'))
+            resp.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            resp.headers['Content-Encoding'] = encoding
+            add_vary(resp, 'Accept-Encoding')
+            return resp
+    return None
+
+
+# 压缩URL处理函数的响应，放在response_factory之前，静态文件请求直接返回预压缩的文件
+async def compression_factory(app, handler):
+    async def compress_response(request):
+        encodings = accepted(request.headers.get('Accept-Encoding'))
+        if encodings and request.method in ('GET', 'HEAD') and request.path.startswith(STATIC_PREFIX):
+            resp = static_response(request.path[len(STATIC_PREFIX):], encodings)
+            if resp is not None:
+                return resp
+        resp = await handler(request)
+        # 分块输出和静态文件的响应已经在写出或者由aiohttp自己发送，不在这里压缩
+        if not isinstance(resp, web.Response) or resp.status != 200 or 'Content-Encoding' in resp.headers:
+            return resp
+        body = resp.body
+        if not isinstance(body, (bytes, bytearray)) or len(body) < COMPRESS_MIN_SIZE \
+                or not compressible(resp.content_type):
+            return resp
+        add_vary(resp, 'Accept-Encoding')
+        encoding = next((e for e in encodings if e in supported()), None)
+        if encoding is None:
+            return resp
+        etag = resp.headers.get('ETag')
+        if etag is None or 'Set-Cookie' in resp.headers:
+            resp.body = compress(body, encoding)
+        else:
+            # 有ETag的响应内容只由ETag决定，缓存压缩的结果
+            key = (request.path_qs, etag, encoding)
+            data = _cache.get(key)
+            if data is None:
+                data = compress(body, encoding)
+                _cache[key] = data
+                if len(_cache) > COMPRESS_CACHE_SIZE:
+                    _cache.popitem(last=False)
+            else:
+                _cache.move_to_end(key)
+            resp.body = data
+        resp.headers['Content-Encoding'] = encoding
+        return resp
+    return compress_response
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print('%s files written.' % precompress_static())
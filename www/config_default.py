@@ -2,6 +2,7 @@
 """数据库的默认配置文件"""
 
 configs = {
+    # debug为False时为生产模式：模板不再检查文件是否修改，使用字节码缓存并在启动时全部编译
     'debug': True,
     'db': {
         'host': '127.0.0.1',
@@ -11,7 +12,44 @@ configs = {
         'database': 'mypython3webapp'
     },
     'session': {
-        'secret': 'MyBlog'
+        'secret': 'MyBlog',
+        # cookie的格式：'sha1'(id-expires-sha1，验证时需要查询数据库)或者'token'(签名的会话令牌)
+        'session_format': 'sha1',
+        # 会话令牌的代数，修改之后所有已经签发的令牌失效
+        'session_generation': 0,
+        # 会话缓存，见requestHandler.cookie2user()
+        'session_cache_size': 10000,  # 最多缓存的cookie个数，0表示不缓存
+        'session_cache_ttl': 300,  # 每个cookie最多缓存的秒数
+        'token_check_ttl': 60  # 会话令牌的撤销状态(users.token_gen)最多缓存的秒数
     },
-    'page_size': 10
+    'page_size': 10,
+    # JSON序列化使用的库：'auto'(安装了orjson时使用orjson)、'orjson'或者'json'
+    'json_serializer': 'auto',
+    # 模板的字节码缓存目录，None为系统的临时目录，只在生产模式下使用
+    'templates': {
+        'template_cache_dir': None
+    },
+    # 在线程池中渲染模板，见requestHandler.render_template()
+    'render': {
+        'render_threads': 4,  # 0表示不使用线程池
+        'render_offload_size': 100  # 模板参数中列表的元素个数之和不小于这个值时才使用线程池
+    },
+    # 日志，见accesslog.py
+    'log': {
+        'log_level': 'INFO',
+        'access_log': True,  # 每个请求记录一行JSON格式的访问日志
+        'access_log_file': None  # None表示和其他日志一起输出到stderr
+    },
+    # 响应压缩，见compression.py
+    'compression': {
+        'compress_min_size': 1024,  # 小于这个字节数的响应不压缩
+        'gzip_level': 6,
+        'brotli_quality': 5
+    },
+    # 数据库查询的录制和回放，见dbtrace.py
+    'trace': {
+        'trace_mode': None,  # None, 'record'或者'replay'
+        'trace_file': 'dbtrace.jsonl',
+        'trace_speed': 1.0  # 回放时延迟的倍数，0表示不等待
+    }
 }
\ No newline at end of file
@@ -0,0 +1,231 @@
+# -*- coding: UTF-8 -*-
+"""数据库查询的录制和回放：
+record()包装orm.select和orm.execute，把每次查询的SQL、参数、结果和耗时写入trace文件；
+replay()用trace文件中的结果代替数据库，并按照录制时的耗时分布等待，用于在没有数据库的情况下测量框架本身的开销。
+录制时由后台线程写入trace文件，private字段(如users.passwd)的值不会被写入"""
+import re
+import json
+import time
+import queue
+import atexit
+import base64
+import random
+import asyncio
+import logging
+import threading
+try:
+    import orm
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+# 录制前的orm.select和orm.execute，停止录制或回放时恢复
+_origin = dict(select=orm.select, execute=orm.execute, create_pool=orm.create_pool)
+
+
+# json不能直接保存bytes(压缩字段)，保存为{'__bytes__': base64字符串}
+def _encode(o):
+    if isinstance(o, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(bytes(o)).decode('ascii')}
+    raise TypeError('%r is not JSON serializable' % o)
+
+
+def _decode(d):
+    if '__bytes__' in d:
+        return base64.b64decode(d['__bytes__'])
+    return d
+
+
+# private字段的值在trace文件中替换为REDACTED
+REDACTED = '******'
+_RE_INSERT = re.compile(r'insert\s+into\s+`?\w+`?\s*\(([^)]*)\)', re.I)
+# 占位符以及它前面比较或者赋值的字段名，如`passwd`=?，不是这种形式的占位符字段名为None
+_RE_PARAM = re.compile(r'`?(\w+)`?\s*(?:=|<>|<=|>=|<|>|\s+like)\s*\?|\?', re.I)
+# 正在录制时写入trace文件的线程
+_writer = None
+
+
+# 所有Model中private字段的名字
+def private_fields():
+    names = set()
+    models = list(orm.Model.__subclasses__())
+    while models:
+        m = models.pop()
+        names.update(m.__private_fields__)
+        models.extend(m.__subclasses__())
+    return names
+
+
+# 按SQL语句找出每个参数对应的字段名，将private字段的参数替换为REDACTED
+def redact_args(sql, args, private):
+    m = _RE_INSERT.match(sql)
+    if m:
+        # 多行的insert语句中，每一行的参数都按照字段列表的顺序排列
+        columns = [c.strip(' `') for c in m.group(1).split(',')]
+        names = columns * (len(args) // len(columns) or 1)
+    else:
+        names = [p.group(1) for p in _RE_PARAM.finditer(sql)]
+    return [REDACTED if n < len(names) and names[n] in private else a for n, a in enumerate(args)]
+
+
+def redact(trace, private):
+    trace['args'] = redact_args(trace['sql'], trace['args'], private)
+    if 'rows' in trace:
+        trace['rows'] = [{k: REDACTED if k in private else v for k, v in r.items()} for r in trace['rows']]
+    return trace
+
+
+# 在后台线程中去掉private字段的值并写入trace文件，事件循环中只需要把查询放入队列
+class TraceWriter(threading.Thread):
+    def __init__(self, path):
+        super(TraceWriter, self).__init__(name='dbtrace', daemon=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._queue = queue.Queue()
+
+    def put(self, trace):
+        self._queue.put(trace)
+
+    def run(self):
+        private = None
+        while True:
+            trace = self._queue.get()
+            if trace is None:
+                break
+            # 开始录制时还可能没有导入models，第一次写入时才查找private字段
+            if private is None:
+                private = private_fields()
+            self._file.write(json.dumps(redact(trace, private), ensure_ascii=False, default=_encode))
+            self._file.write('\n')
+            # 队列中暂时没有查询时才flush
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    # 写完队列中剩余的查询后结束线程
+    def stop(self):
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+
+
+def record(path):
+    """
+    Record every orm.select/orm.execute call into file path, one JSON object per line.
+    """
+    global _writer
+    select, execute = _origin['select'], _origin['execute']
+    writer = _writer = TraceWriter(path)
+    writer.start()
+    atexit.register(writer.stop)
+
+    # 结果和参数复制一份再放入队列，写入之前调用者修改它们不会影响trace
+    async def record_select(sql, args, size=None):
+        start = time.time()
+        rs = await select(sql, args, size)
+        writer.put(dict(op='select', sql=sql, args=list(args or ()), rows=[dict(r) for r in rs],
+                        latency=time.time() - start))
+        return rs
+
+    async def record_execute(sql, args):
+        start = time.time()
+        affected = await execute(sql, args)
+        writer.put(dict(op='execute', sql=sql, args=list(args or ()), affected=affected, latency=time.time() - start))
+        return affected
+
+    orm.select = record_select
+    orm.execute = record_execute
+    logging.info('record database queries to %s' % path)
+
+
+class Replayer(object):
+    """
+    Serve orm.select/orm.execute from a recorded trace file.
+    Results are matched by sql and args first, then by sql only (the shape of the query);
+    the latency is sampled from the latencies recorded for the same shape.
+    """
+    def __init__(self, path, speed=1.0, seed=0):
+        self._speed = speed
+        self._random = random.Random(seed)
+        self._exact = dict()
+        self._shapes = dict()
+        self._latencies = dict()
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                t = json.loads(line, object_hook=_decode)
+                shape = (t['op'], t['sql'])
+                result = t['rows'] if t['op'] == 'select' else t['affected']
+                self._exact.setdefault(self._key(t['op'], t['sql'], t['args']), []).append(result)
+                self._shapes.setdefault(shape, []).append(result)
+                self._latencies.setdefault(shape, []).append(t['latency'])
+        # 同一条查询有多个结果时，依次循环返回
+        self._cursor = dict()
+        logging.info('replay %s query shapes from %s' % (len(self._shapes), path))
+
+    @staticmethod
+    def _key(op, sql, args):
+        return op, sql, json.dumps(list(args or ()), ensure_ascii=False, default=_encode)
+
+    def _next(self, key, results):
+        n = self._cursor.get(key, 0)
+        self._cursor[key] = n + 1
+        return results[n % len(results)]
+
+    async def _result(self, op, sql, args):
+        shape = (op, sql)
+        latencies = self._latencies.get(shape)
+        if latencies and self._speed:
+            await asyncio.sleep(self._random.choice(latencies) * self._speed)
+        key = self._key(op, sql, args)
+        if key in self._exact:
+            return self._next(key, self._exact[key])
+        if shape in self._shapes:
+            return self._next(shape, self._shapes[shape])
+        logging.warning('query not found in trace: %s' % sql)
+        return None
+
+    async def select(self, sql, args, size=None):
+        rs = await self._result('select', sql, args)
+        if rs is None:
+            return []
+        return rs[:size] if size else rs
+
+    async def execute(self, sql, args):
+        affected = await self._result('execute', sql, args)
+        return 0 if affected is None else affected
+
+    async def create_pool(self, loop, **kw):
+        logging.info('replay mode, skip creating database connection pool.')
+
+
+def replay(path, speed=1.0, seed=0):
+    """
+    Replace orm.select/orm.execute with a Replayer of file path.
+    """
+    replayer = Replayer(path, speed, seed)
+    orm.select = replayer.select
+    orm.execute = replayer.execute
+    orm.create_pool = replayer.create_pool
+    return replayer
+
+
+# 恢复原来的orm.select和orm.execute，正在录制时写完剩余的查询
+def reset():
+    global _writer
+    for name, fn in _origin.items():
+        setattr(orm, name, fn)
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+# 根据配置文件中的trace_mode启用录制或者回放
+def init_trace(configs):
+    mode = configs.get('trace_mode')
+    if mode == 'record':
+        record(configs.trace_file)
+    elif mode == 'replay':
+        replay(configs.trace_file, configs.get('trace_speed', 1.0))
+    elif mode:
+        raise ValueError('Invalid trace mode: %s' % mode)
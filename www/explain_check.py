@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+"""检查所有URL处理函数执行的查询是否用到了索引：
+依次请求add_routes(app, 'handlers')注册的每个GET路由(会写数据库的只在未登录时请求，以及几个不会写数据库的POST请求)，记录执行过的每一种SQL语句，
+再对每种SELECT语句执行EXPLAIN。扫描的行数超过MAX_ROWS，或者用到了filesort、临时表时，检查失败。
+用法：python explain_check.py [max_rows]"""
+import sys
+import asyncio
+import logging
+from aiohttp.test_utils import TestServer, TestClient
+try:
+    import orm
+    import archive
+    from app import make_app
+    from config import configs
+    from handlers import COOKIE_NAME, user2cookie
+    from models import User, Blog
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+# EXPLAIN中每张表允许扫描的最大行数
+MAX_ROWS = 1000
+# 已知无法避免的查询，SQL中包含这些字符串时只报告不判定失败，例如分页时统计总数
+ALLOWED = (
+    'select count(id) _num_',
+)
+# 会写数据库的GET请求(登出时会吊销会话)，只在没有登录时请求
+UNSAFE_GETS = ('/signout',)
+
+
+# 记录执行过的每种SQL语句(不包含参数的值)，保留第一次执行时的参数用于EXPLAIN
+class QueryRecorder(object):
+    def __init__(self):
+        self.shapes = dict()
+        self._select = orm.select
+
+    async def select(self, sql, args, size=None):
+        if sql not in self.shapes:
+            self.shapes[sql] = list(args or ())
+        return await self._select(sql, args, size)
+
+    def install(self):
+        orm.select = self.select
+
+    def uninstall(self):
+        orm.select = self._select
+
+
+# 需要请求的POST，这些请求在写数据库之前就会因为参数检查失败而返回
+def safe_posts(user):
+    return [
+        ('/api/authenticate', dict(email=user.email, passwd='0' * 40)),
+        ('/api/users', dict(email=user.email, name=user.name, passwd='0' * 40)),
+    ]
+
+
+async def exercise(app, loop, blog, admin):
+    client = TestClient(TestServer(app), loop=loop)
+    await client.start_server()
+    try:
+        cookies = [None]
+        if admin is not None:
+            cookies.append({COOKIE_NAME: user2cookie(admin, 600)})
+        for resource in app.router.resources():
+            info = resource.get_info()
+            path = info.get('path') or info.get('formatter')
+            # 静态文件不访问数据库
+            if path is None:
+                continue
+            path = path.replace('{id}', blog.id if blog else '0')
+            for route in resource:
+                if route.method != 'GET':
+                    continue
+                for cookie in cookies:
+                    if cookie is not None and path in UNSAFE_GETS:
+                        continue
+                    resp = await client.get(path, cookies=cookie, allow_redirects=False)
+                    logging.info('GET %s => %s' % (path, resp.status))
+                    await resp.release()
+        if admin is not None:
+            for path, data in safe_posts(admin):
+                resp = await client.post(path, json=data)
+                logging.info('POST %s => %s' % (path, resp.status))
+                await resp.release()
+    finally:
+        await client.close()
+
+
+# 对一条SELECT语句执行EXPLAIN，返回发现的问题
+async def explain(select, sql, args, max_rows):
+    problems = []
+    for r in await select('explain %s' % sql, args):
+        extra = r.get('Extra') or ''
+        rows = r.get('rows') or 0
+        table = r.get('table')
+        if rows > max_rows:
+            problems.append('%s: scans %s rows (type: %s, key: %s)' % (table, rows, r.get('type'), r.get('key')))
+        if 'Using filesort' in extra:
+            problems.append('%s: using filesort' % table)
+        if 'Using temporary' in extra:
+            problems.append('%s: using temporary table' % table)
+    return problems
+
+
+async def check(loop, max_rows):
+    await orm.create_pool(loop=loop, **configs)
+    await archive.load_all_archive_tables()
+    # 使用数据库中已有的数据作为路由参数
+    blogs = await Blog.findAll(orderBy='created_at desc', limit=1)
+    admins = await User.findAll('admin=?', [True], limit=1)
+    recorder = QueryRecorder()
+    recorder.install()
+    try:
+        await exercise(make_app(loop), loop, blogs[0] if blogs else None, admins[0] if admins else None)
+    finally:
+        recorder.uninstall()
+
+    failed = 0
+    for sql, args in recorder.shapes.items():
+        problems = await explain(orm.select, sql, args, max_rows)
+        allowed = any(a in sql for a in ALLOWED)
+        status = 'OK' if not problems else ('ALLOWED' if allowed else 'FAIL')
+        if status == 'FAIL':
+            failed += 1
+        print('[%s] %s' % (status, sql))
+        for p in problems:
+            print('    %s' % p)
+    print('%s query shapes checked, %s failed.' % (len(recorder.shapes), failed))
+    return failed
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if argv and not argv[0].isdigit():
+        print('Usage: python explain_check.py [max_rows]')
+        exit(0)
+    loop = asyncio.get_event_loop()
+    failed = loop.run_until_complete(check(loop, int(argv[0]) if argv else MAX_ROWS))
+    exit(1 if failed else 0)
@@ -0,0 +1,206 @@
+# -*- coding: UTF-8 -*-
+"""生成用于性能测试的users、blogs和comments数据：
+博文的热度服从Zipf分布，评论数因此高度倾斜；博文内容是长度不一的Markdown文本。
+相同的seed和epoch生成完全相同的数据。
+用法：python gen_data.py [users] [blogs] [comments] [seed] [epoch]"""
+import sys
+import time
+import asyncio
+import hashlib
+import logging
+import random
+try:
+    import orm
+    from config import configs
+    from models import User, Blog, Comment
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+# 每条INSERT语句最多插入的行数
+INSERT_BATCH_SIZE = 1000
+# 每条INSERT语句的参数最多的字节数，需要远小于MySQL的max_allowed_packet(5.7默认为4MB)
+INSERT_BATCH_BYTES = 1 << 20
+# 估计一行数据的字节数时，除了content以外的字段按这个字节数计算
+ROW_OVERHEAD = 400
+# 同时执行的INSERT语句数，不能超过连接池的大小
+INSERT_CONCURRENCY = 4
+# Zipf分布的参数，越大热门博文的评论越集中
+ZIPF_S = 1.1
+# 数据的时间跨度(秒)，默认为EPOCH之前的两年
+TIME_SPAN = 2 * 365 * 86400
+# 生成的数据中最晚的时间(2024-01-01 00:00:00 UTC)，不使用当前时间，每次运行生成的数据才会相同
+EPOCH = 1704067200
+# 所有生成的用户的密码都是这个
+PASSWORD = 'password'
+
+WORDS = ('python', 'asyncio', 'aiohttp', 'jinja2', 'mysql', 'orm', 'model', 'blog', 'comment', 'user',
+         'index', 'query', 'cache', 'server', 'client', 'request', 'response', 'template', 'cookie',
+         'session', 'the', 'a', 'is', 'of', 'and', 'to', 'in', 'for', 'with', 'on', 'this', 'that',
+         '我们', '可以', '使用', '数据库', '函数', '参数', '返回', '异步', '协程', '测试', '性能', '页面')
+
+
+def make_id(rng, t):
+    # 和models.next_id()的格式相同，但是随机部分由rng生成，保证结果可以重复
+    return '%015d%032x000' % (int(t * 1000), rng.getrandbits(128))
+
+
+# 预先生成一段随机的单词序列，句子从中随机截取，比每个句子都随机选择单词快得多
+class TextGenerator(object):
+    POOL_SIZE = 1 << 16
+
+    def __init__(self, rng):
+        self._rng = rng
+        self._pool = rng.choices(WORDS, k=self.POOL_SIZE)
+
+    def sentence(self, min_words, max_words):
+        rng = self._rng
+        n = rng.randint(min_words, max_words)
+        start = rng.randrange(self.POOL_SIZE - n)
+        return ' '.join(self._pool[start:start + n]).capitalize() + '.'
+
+    def markdown(self):
+        # 段落数服从对数正态分布，大部分博文较短，少数很长
+        rng = self._rng
+        paragraphs = max(1, min(200, int(rng.lognormvariate(1.5, 0.8))))
+        L = []
+        for n in range(paragraphs):
+            r = rng.random()
+            if r < 0.1:
+                L.append('## %s' % self.sentence(2, 6))
+            elif r < 0.2:
+                L.append('```python\n%s\n```' % '\n'.join('    %s()' % w for w in self.sentence(2, 10)[:-1].lower().split()))
+            elif r < 0.3:
+                L.append('\n'.join('* %s' % self.sentence(3, 10) for i in range(rng.randint(2, 6))))
+            else:
+                L.append(' '.join(self.sentence(5, 20) for i in range(rng.randint(1, 8))))
+        return '\n\n'.join(L)
+
+
+# 前n个排名的累积权重，排名为k的概率正比于1/k^s
+def zipf_cum_weights(n, s=ZIPF_S):
+    cum = []
+    total = 0.0
+    for k in range(1, n + 1):
+        total += 1.0 / (k ** s)
+        cum.append(total)
+    return cum
+
+
+# 按行数和字节数把对象分批插入，同时执行的INSERT语句不超过INSERT_CONCURRENCY条
+# 所有的语句都在执行时，add()会等待，生成数据的速度不会超过写入的速度，内存中最多只有几批数据
+class BatchInserter(object):
+    def __init__(self, model, sem):
+        self._model = model
+        self._sem = sem
+        self._batch = []
+        self._bytes = 0
+        self._tasks = []
+        self.rows = 0
+
+    async def add(self, obj):
+        size = ROW_OVERHEAD + len(obj.get('content', '').encode('utf-8'))
+        if self._batch and (len(self._batch) >= INSERT_BATCH_SIZE or self._bytes + size > INSERT_BATCH_BYTES):
+            await self.flush()
+        self._batch.append(obj)
+        self._bytes += size
+
+    async def flush(self):
+        if not self._batch:
+            return
+        await self._sem.acquire()
+        # 已经完成的INSERT如果出错，在这里抛出异常
+        for t in [t for t in self._tasks if t.done()]:
+            self._tasks.remove(t)
+            t.result()
+        self._tasks.append(asyncio.ensure_future(self._insert(self._batch)))
+        self.rows += len(self._batch)
+        self._batch = []
+        self._bytes = 0
+
+    async def _insert(self, batch):
+        try:
+            await self._model.saveAll(batch, len(batch))
+        finally:
+            self._sem.release()
+
+    async def close(self):
+        await self.flush()
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+
+
+async def generate(n_users, n_blogs, n_comments, seed, epoch=EPOCH):
+    rng = random.Random(seed)
+    text = TextGenerator(rng)
+    now = epoch
+    start = now - TIME_SPAN
+    sem = asyncio.Semaphore(INSERT_CONCURRENCY)
+    begin = time.time()
+
+    users = []
+    inserter = BatchInserter(User, sem)
+    for n in range(n_users):
+        t = start + TIME_SPAN * n / max(1, n_users)
+        uid = make_id(rng, t)
+        email = 'user%d@example.com' % n
+        # 和浏览器端一样先计算sha1(email:password)，再和uid混合计算一次
+        browser_sha1 = hashlib.sha1(('%s:%s' % (email, PASSWORD)).encode('utf-8')).hexdigest()
+        u = User(id=uid, email=email, name='user%d' % n, admin=(n == 0), created_at=t,
+                 passwd=hashlib.sha1(('%s:%s' % (uid, browser_sha1)).encode('utf-8')).hexdigest(),
+                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
+        users.append(u)
+        await inserter.add(u)
+    await inserter.close()
+    logging.info('%s users generated' % len(users))
+    # 只有少数用户发表博文，评论的作者同样服从Zipf分布
+    authors = users[:max(1, len(users) // 100)]
+    user_weights = zipf_cum_weights(len(users))
+
+    blogs = []
+    inserter = BatchInserter(Blog, sem)
+    for n in range(n_blogs):
+        t = start + TIME_SPAN * n / max(1, n_blogs)
+        u = rng.choice(authors)
+        b = Blog(id=make_id(rng, t), user_id=u.id, user_name=u.name, user_image=u.image,
+                 name=text.sentence(2, 6)[:50], summary=text.sentence(10, 30)[:200],
+                 content=text.markdown(), created_at=t)
+        # 只保留生成评论需要的字段
+        blogs.append((b.id, t))
+        await inserter.add(b)
+    await inserter.close()
+    logging.info('%s blogs generated' % len(blogs))
+
+    # 博文的热度排名和发表时间无关
+    popular = list(blogs)
+    rng.shuffle(popular)
+    blog_weights = zipf_cum_weights(len(popular))
+    inserter = BatchInserter(Comment, sem)
+    done = 0
+    while done < n_comments:
+        size = min(INSERT_BATCH_SIZE, n_comments - done)
+        for (blog_id, blog_t), u in zip(rng.choices(popular, cum_weights=blog_weights, k=size),
+                                        rng.choices(users, cum_weights=user_weights, k=size)):
+            t = blog_t + rng.random() * (now - blog_t)
+            await inserter.add(Comment(id=make_id(rng, t), blog_id=blog_id, user_id=u.id, user_name=u.name,
+                                       user_image=u.image, content=text.sentence(3, 60), created_at=t))
+        done += size
+        if done % (INSERT_BATCH_SIZE * INSERT_CONCURRENCY * 10) < size:
+            logging.info('%s comments generated, %.0f rows/s' % (done, done / (time.time() - begin)))
+    await inserter.close()
+    logging.info('done in %.1fs' % (time.time() - begin))
+
+
+async def main(loop, n_users, n_blogs, n_comments, seed, epoch):
+    await orm.create_pool(loop=loop, **configs)
+    await orm.load_column_types()
+    await generate(n_users, n_blogs, n_comments, seed, epoch)
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if len(argv) > 5 or not all(a.isdigit() for a in argv):
+        print('Usage: python gen_data.py [users] [blogs] [comments] [seed] [epoch]')
+        exit(0)
+    args = [int(a) for a in argv] + [10000, 100000, 10000000, 0, EPOCH][len(argv):]
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, *args))
@@ -1,20 +1,29 @@
 # -*- coding: UTF-8 -*-
 """具体的函数"""
 import asyncio, re, hashlib
-import time, json, logging
+import time, logging
 from aiohttp import web
 
 try:
-    from requestHandler import get, post
+    from requestHandler import get, post, invalidate_session, user2token, revoke_user
     from models import User, Comment, Blog, next_id
+    from orm import changes
     from apis import APIValueError, APIError
     from apis import APIPermissionError, Page, APIResourceNotFoundError
     from config import configs
     import markdown2
+    import serializer
 except ImportError:
     raise ImportError('The file is not found. Please check the file name!')
 
 # --------------------------------------主页---------------------------------------------------
+# 条件GET的版本号：相关的表没有被修改时，客户端缓存的页面仍然有效
+async def blogs_version(request):
+    return await changes(Blog)
+
+async def blog_version(request):
+    return await changes(Blog, Comment)
+
 # @get('/')
 # async def index(request, *, page='1'):
 #     return {
@@ -24,12 +33,12 @@ except ImportError:
 #         "page_index": get_page_index(page)
 #     }
 
-@get('/')
+@get('/', version=blogs_version)
 async def index(request, *, page='1'):
     page_index = get_page_index(page)
     num = await Blog.findNumber('count(id)')
     if not num or num == 0:
-        logging.info('the type of num is :%s' % type(num))
+        logging.debug('the type of num is :%s', type(num))
         blogs = []
     else:
         page = Page(num, page_index)
@@ -50,8 +59,6 @@ async def index(request, *, page='1'):
 @get('/api/users')
 async def api_get_users():
     users = await User.findAll(orderBy='created_at desc')
-    for u in users:
-        u.passwd = '******'
     return dict(users=users)
 
 # 用户注册页面
@@ -70,6 +77,9 @@ def user2cookie(user, max_age):
     """
     Generate cookie str by user(id-expires-sha1).
     """
+    # 配置为token时使用签名的会话令牌，验证时不需要查询数据库
+    if configs.session_format == 'token':
+        return user2token(user, max_age)
     # build cookie string by: id-expires-sha1
     # 过期时间是创建时间+存活时间
     expires = str(int(time.time() + max_age))
@@ -108,9 +118,9 @@ async def api_register_user(*, email, name, passwd):
     # 86400秒为24小时
     # 设置cookie
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    user.passwd = '********'
+    # User.passwd是private字段，序列化时不会输出
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 # 用户登录
@@ -141,26 +151,30 @@ async def authenticate(*, email, passwd):
     # authenticate ok, set cookie
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    user.passwd = "********"
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serializer.dumps(user)
     return r
 
 # 用户登录页面
-@get('/signin')
+@get('/signin', auth=False)
 def signin():
     return {
         "__template__": 'signin.html'
     }
 
-# 用户退出
+# 用户退出，只退出当前的浏览器
+# /signout?everywhere=1在所有设备上退出：撤销这个用户签发过的所有会话令牌，其他浏览器中的登录也会失效
 @get('/signout')
-def signout(request):
+async def signout(request, *, everywhere=''):
     referer = request.headers.get('Referer')
     r = web.HTTPFound(referer or '/')
-    # 清理掉cookie来退出账户
+    # 删除缓存的会话，清理掉cookie来退出账户
+    cookie_str = request.cookies.get(COOKIE_NAME)
+    invalidate_session(cookie_str)
+    if everywhere and request.__user__ is not None:
+        await revoke_user(request.__user__.id)
     r.set_cookie(COOKIE_NAME, '-deleted-', max_age=0, httponly=True)
-    logging.info('user signed out.')
+    logging.debug('user signed out.')
     return r
 
 
@@ -225,12 +239,14 @@ async def api_create_blog(request, *, name, summary, content):
 # 在删除某一条博文后会重新装载manage_blogs.html页面
 @post('/api/blogs/delete/{id}')
 async def api_delete_blog(id, request):
-    logging.info('删除博客的ID为：%s' % id)
+    logging.debug('删除博客的ID为：%s', id)
     check_admin(request)  # 有管理权限才能删除
     b = await Blog.find(id)
     if b is None:
         raise APIResourceNotFoundError('Blog')
     await b.remove()
+    # 用一条语句删除这篇博文下的所有评论
+    await Comment.deleteWhere('blog_id=?', [id])
     return dict(id=id)
 
 
@@ -247,7 +263,7 @@ def manage_modify_blog(id, request):
 # 将修改后的博文保存到数据库中
 @post('/api/blogs/modify')
 async def api_modify_blog(request, *, id, name, summary, content):
-    logging.info('修改的博客的ID为：%s' % id)
+    logging.debug('修改的博客的ID为：%s', id)
 
     if not name or not name.strip():
         raise APIValueError('name', 'name cannot be empty.')
@@ -265,10 +281,12 @@ async def api_modify_blog(request, *, id, name, summary, content):
     return blog
 
 # 具体查看某一条博文
-@get('/blog/{id}')
+# 评论很多时页面很大，分块输出，并且在线程池中渲染
+@get('/blog/{id}', version=blog_version, stream=True, offload=True)
 async def get_blog(id, request):
     blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    # 评论不会早于博文，跳过博文发表之前月份的归档表
+    comments = await Comment.query().filter(blog_id=id).orderBy('-created_at').since(blog.created_at).all()
     for c in comments:
         c.html_content = text2html(c.content)
         # 利用markdown2.py文件将普通的文本博客转化成使用Markdown语法的文件，以便展示成HTML文件
@@ -293,13 +311,14 @@ def manage_blogs(request, *, page='1'):
 
 # ----------------------利用api来获取博文的数据-----------------------------------------
 # 使用api来获取某一条具体的博文
-@get('/api/blogs/{id}')
+# 公开的API，不需要登录
+@get('/api/blogs/{id}', version=blogs_version, auth=False)
 async def api_get_blog(*, id):
     blog = await Blog.find(id)
     return blog
 
 # 使用api来获取分页的博文数据
-@get('/api/blogs')
+@get('/api/blogs', version=blogs_version, auth=False)
 async def api_blogs(*, page='1'):
     page_index = get_page_index(page)
     blogs_count = await Blog.findNumber('count(id)')
@@ -345,7 +364,7 @@ async def api_create_comment(id, request, *, content):
 # 删除某条评论
 @post('/api/comments/delete/{id}')
 async def api_delete_comments(id, request):
-    logging.info(id)
+    logging.debug(id)
     check_admin(request)
     comment = await Comment.find(id)
     if comment is None:
@@ -361,7 +380,8 @@ async def api_comments(*, page='1'):
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    # 通过一条JOIN语句同时取出评论所属博文的标题
+    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), join=Blog, fields=['name'])
     return dict(page=p, comments=comments)
 
 
@@ -370,7 +390,7 @@ async def api_comments(*, page='1'):
 @get('/show_all_users')
 async def show_all_users():
     users = await User.findAll(orderBy='created_at desc')
-    logging.info('to index...')
+    logging.debug('to index...')
     return {
         '__template__': 'all_users.html',
         'users:': users
@@ -399,9 +419,6 @@ async def api_get_users(*, page='1'):
         return dict(page=p, users=())
     # page.offset表示从那一行开始检索，page.limit表示检索多少行
     users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-
-    for u in users:
-        u.passwd = '*******'
     return dict(page=p, users=users)
 
 
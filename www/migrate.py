@@ -0,0 +1,131 @@
+# -*- coding: UTF-8 -*-
+"""基于orm的数据库迁移工具：按版本号依次执行migrations目录下的迁移，大表的回填按主键分批进行，可以中断后继续"""
+import os
+import sys
+import time
+import asyncio
+import logging
+try:
+    import orm
+    from orm import Model, StringField, IntegerField, FloatField
+    from config import configs
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+# 回填时每批处理的行数
+BACKFILL_BATCH_SIZE = 500
+# 回填时每批之间暂停的秒数，避免长时间占用数据库
+BACKFILL_PAUSE = 0.1
+# 迁移文件所在的包，文件名格式为：版本号_名称.py，如0001_compress_content.py
+MIGRATIONS_PACKAGE = 'migrations'
+
+
+# 已经执行过的迁移
+class SchemaMigration(Model):
+    __table__ = 'schema_migrations'
+
+    version = StringField(primary_key=True, ddl='varchar(20)')
+    name = StringField(ddl='varchar(100)')
+    applied_at = FloatField(default=time.time)
+
+
+# 回填的进度，last_key为最后处理完的主键，中断后从这里继续
+class MigrationCheckpoint(Model):
+    __table__ = 'migration_checkpoints'
+
+    name = StringField(primary_key=True, ddl='varchar(100)')
+    last_key = StringField(ddl='varchar(50)')
+    rows = IntegerField()
+    updated_at = FloatField(default=time.time)
+
+
+async def create_tables():
+    await orm.execute('create table if not exists `schema_migrations` ('
+                      '`version` varchar(20) not null, `name` varchar(100) not null, '
+                      '`applied_at` real not null, primary key (`version`))', [])
+    await orm.execute('create table if not exists `migration_checkpoints` ('
+                      '`name` varchar(100) not null, `last_key` varchar(50) not null, `rows` bigint not null, '
+                      '`updated_at` real not null, primary key (`name`))', [])
+    # orm.touch()修改的表的版本号
+    await orm.execute('create table if not exists `%s` ('
+                      '`name` varchar(100) not null, `version` bigint not null, '
+                      '`updated_at` real not null, primary key (`name`))' % orm.VERSION_TABLE, [])
+
+
+async def backfill(name, model, fn, fields=None, where=None, args=None,
+                   batch_size=BACKFILL_BATCH_SIZE, pause=BACKFILL_PAUSE):
+    """
+    Call fn(rows) for all rows of model, in batches ordered by primary key.
+    The progress is saved as checkpoint name, so an interrupted backfill continues from the last batch.
+    """
+    pk = model.__primary_key__
+    checkpoint = await MigrationCheckpoint.find(name)
+    if checkpoint is None:
+        checkpoint = MigrationCheckpoint(name=name, last_key='', rows=0)
+    elif checkpoint.last_key:
+        logging.info('%s: resume from %s (%s rows done)' % (name, checkpoint.last_key, checkpoint.rows))
+    columns = ', '.join(map(lambda f: '`%s`' % f, [pk] + [f for f in (fields or []) if f != pk]))
+    sql = 'select %s from `%s` where `%s`>?%s order by `%s` limit ?' % (
+        columns, model.__table__, pk, ' and (%s)' % where if where else '', pk)
+    while True:
+        rs = await orm.select(sql, [checkpoint.last_key] + list(args or []) + [batch_size])
+        if not rs:
+            break
+        await fn(rs)
+        checkpoint.last_key = rs[-1][pk]
+        checkpoint.rows += len(rs)
+        checkpoint.updated_at = time.time()
+        await checkpoint.upsert()
+        logging.info('%s: %s rows done, last key: %s' % (name, checkpoint.rows, checkpoint.last_key))
+        if len(rs) < batch_size:
+            break
+        await asyncio.sleep(pause)
+    return checkpoint.rows
+
+
+# 找出migrations目录下的所有迁移，按版本号排序
+def find_migrations():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), MIGRATIONS_PACKAGE)
+    L = []
+    for f in sorted(os.listdir(path)):
+        if f.endswith('.py') and f[0].isdigit():
+            version, _, name = f[:-3].partition('_')
+            L.append((version, name, '%s.%s' % (MIGRATIONS_PACKAGE, f[:-3])))
+    return L
+
+
+async def migrate():
+    await create_tables()
+    applied = set(m.version for m in await SchemaMigration.findAll())
+    for version, name, module_name in find_migrations():
+        if version in applied:
+            continue
+        logging.info('apply migration %s %s...' % (version, name))
+        mod = __import__(module_name, globals(), locals(), ['up'])
+        await mod.up()
+        await SchemaMigration(version=version, name=name).save()
+        logging.info('migration %s %s done.' % (version, name))
+
+
+async def status():
+    await create_tables()
+    applied = dict((m.version, m) for m in await SchemaMigration.findAll())
+    for version, name, _ in find_migrations():
+        print('%s %s %s' % ('[x]' if version in applied else '[ ]', version, name))
+
+
+async def main(loop, command):
+    await orm.create_pool(loop=loop, **configs)
+    if command == 'status':
+        await status()
+    else:
+        await migrate()
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if argv and argv[0] not in ('migrate', 'status'):
+        print('Usage: python migrate.py [migrate|status]')
+        exit(0)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, argv[0] if argv else 'migrate'))
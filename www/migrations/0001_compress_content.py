@@ -0,0 +1,9 @@
+# -*- coding: UTF-8 -*-
+"""将blogs和comments的content列改为压缩存储。先回填新的blob列再改名，只在改名时短暂锁表(见compress_content.migrate())"""
+from models import Blog, Comment
+from compress_content import migrate
+
+
+async def up():
+    for model in (Blog, Comment):
+        await migrate(model)
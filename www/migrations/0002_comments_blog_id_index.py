@@ -0,0 +1,15 @@
+# -*- coding: UTF-8 -*-
+"""给comments.blog_id加上索引，/blog/{id}按博文查询评论时不再全表扫描"""
+import orm
+
+
+async def up():
+    # 按旧版本的schema.sql建的库中已经有这个索引
+    rs = await orm.select('select count(*) as `n` from information_schema.statistics '
+                          'where `table_schema`=database() and `table_name`=? and `index_name`=?',
+                          ['comments', 'idx_blog_id'])
+    if rs and rs[0]['n']:
+        return
+    # 使用inplace方式在线建索引，建索引的过程中不锁表
+    await orm.execute('alter table `comments` add key `idx_blog_id` (`blog_id`, `created_at`), '
+                      'algorithm=inplace, lock=none', [])
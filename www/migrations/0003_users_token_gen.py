@@ -0,0 +1,14 @@
+# -*- coding: UTF-8 -*-
+"""给users加上token_gen列，撤销会话令牌时加1，保存在数据库中，重启之后以及其他进程中同样有效"""
+import orm
+
+
+async def up():
+    rs = await orm.select('select count(*) as `n` from information_schema.columns '
+                          'where `table_schema`=database() and `table_name`=? and `column_name`=?',
+                          ['users', 'token_gen'])
+    if rs and rs[0]['n']:
+        return
+    # 在最后添加有默认值的列可以在线执行，不锁表
+    await orm.execute('alter table `users` add column `token_gen` bigint not null default 0, '
+                      'algorithm=inplace, lock=none', [])
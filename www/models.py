@@ -2,7 +2,7 @@
 """需要用到的三个模型"""
 import time, uuid
 try:
-    from orm import Model, StringField, BooleanField, FloatField, TextField
+    from orm import Model, StringField, BooleanField, FloatField, IntegerField, CompressedTextField
 except ImportError:
     raise ImportError('The file is not found. Please check the file name!')
 
@@ -18,12 +18,20 @@ class User(Model):
     # 主键id的缺省值是函数next_id
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
-    passwd = StringField(ddl='varchar(50)')
+    # 密码不会出现在序列化的结果中
+    passwd = StringField(ddl='varchar(50)', private=True)
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
     # 创建时间created_at的缺省值是函数time.time
     created_at = FloatField(default=time.time)
+    # 会话令牌的代数，签发的令牌中的代数和它不同时令牌无效，见requestHandler.token2user()
+    token_gen = IntegerField()
+
+    # 修改用户(如取消管理员权限)时代数加1，之前签发给这个用户的令牌中的声明已经过时，全部失效
+    async def update(self):
+        self.token_gen = (self.getValue('token_gen') or 0) + 1
+        await super(User, self).update()
 
 class Blog(Model):
     __table__ = 'blogs'
@@ -34,7 +42,8 @@ class Blog(Model):
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    # 博文内容压缩后存储，从数据库读出时解压
+    content = CompressedTextField()
     created_at = FloatField(default=time.time)
 
 class Comment(Model):
@@ -45,5 +54,5 @@ class Comment(Model):
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
+    content = CompressedTextField()
     created_at = FloatField(default=time.time)
\ No newline at end of file
@@ -1,12 +1,32 @@
 # -*- coding: UTF-8 -*-
 """自己编写的ORM框架"""
+import asyncio
 import logging
+import time
+import zlib
+import contextvars
 import aiomysql
 
+# zstd压缩是可选的，没有安装zstandard时只使用zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 logging.basicConfig(level=logging.INFO)
 
 def log(sql, args):
-    logging.info('SQL: %s' % sql)
+    logging.debug('SQL: %s', sql)
+
+# 当前请求的数据库查询统计[耗时, 次数]，由accesslog.access_factory为每个请求设置，不在请求中时为None
+db_stats = contextvars.ContextVar('db_stats', default=None)
+
+
+def _record(start):
+    stats = db_stats.get()
+    if stats is not None:
+        stats[0] += time.perf_counter() - start
+        stats[1] += 1
 
 
 # 创建出数据库连接池
@@ -35,6 +55,7 @@ async def create_pool(loop, **kw):
 async def select(sql, args, size=None):
     log(sql, args)
     global __pool
+    start = time.perf_counter()
     # 从数据库连接池中获取一个数据库连接
     with (await __pool) as conn:
         cur = await conn.cursor(aiomysql.DictCursor)
@@ -47,7 +68,8 @@ async def select(sql, args, size=None):
         else:
             rs = await cur.fetchall()
         await cur.close()
-        logging.info('rows returned: %s' % len(rs))
+        logging.debug('rows returned: %s', len(rs))
+        _record(start)
         return rs
 
 
@@ -55,6 +77,7 @@ async def select(sql, args, size=None):
 async def execute(sql, args):
     log(sql, args)
     global __pool
+    start = time.perf_counter()
     with (await __pool) as conn:
         try:
             cur = await conn.cursor(aiomysql.DictCursor)
@@ -63,8 +86,119 @@ async def execute(sql, args):
             await cur.close()
         except BaseException as e:
             raise
+        _record(start)
         return affected
 
+
+# 在同一个连接上锁住tables之后依次执行sqls，用于迁移中需要短暂阻塞写入的几条语句
+async def execute_locked(tables, sqls):
+    global __pool
+    with (await __pool) as conn:
+        cur = await conn.cursor()
+        try:
+            await cur.execute('lock tables %s' % ', '.join(map(lambda t: '`%s` write' % t, tables)))
+            for sql in sqls:
+                log(sql, None)
+                await cur.execute(sql)
+        finally:
+            # 执行失败时也要释放锁，连接放回连接池之后还会被其它查询使用
+            await cur.execute('unlock tables')
+            await cur.close()
+
+# 每张表的版本号保存在数据库的table_versions表中，每次通过Model修改表之后加1，用于生成条件GET的ETag
+# 保存在数据库中，所以多个进程以及gen_data.py等脚本通过Model的修改都会改变版本号
+# 直接用execute()修改表中的数据(不只是移动或者重新编码)时，需要调用touch()
+VERSION_TABLE = 'table_versions'
+# 表名 => 修改表时调用的函数fn(pk)
+_listeners = dict()
+
+
+async def touch(table, pk=None):
+    """
+    Bump the version of table after it is modified, pk is the primary key of the modified row or None if unknown.
+    """
+    await execute('insert into `%s` (`name`, `version`, `updated_at`) values (?, 1, ?) '
+                  'on duplicate key update `version`=`version`+1, `updated_at`=values(`updated_at`)' % VERSION_TABLE,
+                  [table, time.time()])
+    for fn in _listeners.get(table, ()):
+        fn(pk)
+
+
+def listen(model, fn):
+    """
+    Call fn(pk) after rows of model are modified by this process, pk is None if the rows are unknown.
+    """
+    _listeners.setdefault(model.__table__, []).append(fn)
+
+
+async def changes(*models):
+    """
+    Return (version, last_modified) of the tables of models, version changes after any of them is modified.
+    last_modified is None if none of the tables has been modified.
+    """
+    names = [m.__table__ for m in models]
+    rs = await select('select `name`, `version`, `updated_at` from `%s` where `name` in (%s)'
+                      % (VERSION_TABLE, create_args_string(len(names))), names)
+    found = dict((r['name'], r) for r in rs)
+    versions = []
+    last_modified = None
+    for name in names:
+        r = found.get(name)
+        if r is None:
+            versions.append('0')
+            continue
+        # 加上修改时间，table_versions被清空后重新计数的版本号也不会和以前的相同
+        versions.append('%d-%x' % (r['version'], int(r['updated_at'] * 1000)))
+        last_modified = r['updated_at'] if last_modified is None else max(last_modified, r['updated_at'])
+    return '.'.join(versions), last_modified
+
+# 压缩字段的列还是text类型时(迁移0001完成之前)，写入压缩后的bytes在严格模式下会报Incorrect string value，
+# 所以列类型由load_column_types()从数据库中读取，列变成blob之后才开始压缩，在此之前保存原来的文本
+COLUMN_RELOAD_INTERVAL = 60
+
+
+async def load_column_types(*models):
+    """
+    Read the column types of compressed fields of models (all models if not given),
+    values of a compressed field are stored compressed only after its column is a blob.
+    """
+    if not models:
+        models = []
+        subclasses = list(Model.__subclasses__())
+        while subclasses:
+            m = subclasses.pop()
+            models.append(m)
+            subclasses.extend(m.__subclasses__())
+    fields = dict()
+    for m in models:
+        for k in m.__compressed__:
+            fields[(m.__table__, m.__mappings__[k].name or k)] = m.__mappings__[k]
+    if not fields:
+        return
+    tables = list(set(t for t, _ in fields))
+    rs = await select('select `table_name` as `table_name`, `column_name` as `column_name`, `data_type` as `data_type` '
+                      'from information_schema.columns where `table_schema`=database() and `table_name` in (%s)'
+                      % create_args_string(len(tables)), tables)
+    for r in rs:
+        field = fields.get((r['table_name'], r['column_name']))
+        if field is not None:
+            field.binary = r['data_type'].lower().endswith('blob')
+
+
+# 定时重新读取列类型，迁移完成后正在运行的进程不需要重启就会开始压缩
+async def watch_column_types(interval=COLUMN_RELOAD_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await load_column_types()
+        except Exception as e:
+            logging.exception(e)
+
+# findByIds()每条SQL语句中IN列表最多包含的主键个数
+IN_CHUNK_SIZE = 500
+# saveAll()和upsertAll()每条INSERT语句最多包含的行数
+BATCH_SIZE = 500
+
 def create_args_string(param):
     L = []
     for n in range(param):
@@ -72,6 +206,35 @@ def create_args_string(param):
     # 以','为分隔符，将列表合成字符串
     return ", ".join(L)
 
+# 有private字段的Model会加上这些方法：private字段的值不保存在dict中，而是保存在对象的_private中，
+# dict(obj)、json.dumps(obj)和orjson都只能看到dict中的字段，序列化时不需要复制对象也不会输出private字段，
+# obj[key]、obj.key、key in obj和obj.get(key)仍然可以访问private字段
+class PrivateFields(object):
+    def __missing__(self, key):
+        private = self.__dict__.get('_private')
+        if private is not None and key in private:
+            return private[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.__private_fields__:
+            self.__dict__.setdefault('_private', {})[key] = value
+        else:
+            dict.__setitem__(self, key, value)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.__dict__.get('_private', ())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+# 生成 on duplicate key update 子句，fields为需要在主键冲突时更新的字段
+def create_upsert_string(fields):
+    return 'on duplicate key update %s' % ', '.join(map(lambda f: '`%s`=values(`%s`)' % (f, f), fields))
+
 
 # 使用元类来创建对象,会调用__new__()方法创建对象
 # __new__()方法接收到的参数依次是：
@@ -126,12 +289,22 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName  # 保存表名
         attrs['__primary_key__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 除主键外的属性名
+        # 不能被序列化的字段名，有private字段时加上PrivateFields的方法
+        attrs['__private_fields__'] = frozenset(k for k, v in mappings.items() if v.private)
+        if attrs['__private_fields__']:
+            bases = (PrivateFields,) + bases
+        # 需要压缩存储的字段名
+        attrs['__compressed__'] = [k for k in fields if isinstance(mappings[k], CompressedTextField)]
+        # 归档表名(按月份从新到旧排列)，由archive模块在启动和归档之后填入，查询时会一起查询这些表
+        attrs['__archive_tables__'] = []
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句:
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (
             tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (
             tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
+        # 主键冲突时更新所有非主键字段，upsert()传入update_fields时会重新生成这一部分
+        attrs['__upsert__'] = '%s %s' % (attrs['__insert__'], create_upsert_string(fields))
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
         return type.__new__(cls, name, bases, attrs)
 
@@ -146,6 +319,19 @@ class ModelMetaclass(type):
 class Model(dict, metaclass=ModelMetaclass):
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+        # 从数据库中读出的压缩字段是bytes，创建对象时就解压，dict中保存的总是文本
+        for k in self.__compressed__:
+            value = dict.get(self, k)
+            if isinstance(value, (bytes, bytearray)):
+                dict.__setitem__(self, k, self.__mappings__[k].decompress(value))
+        # private字段的值从dict中移到_private中
+        if self.__private_fields__:
+            self.__dict__['_private'] = {k: dict.pop(self, k) for k in self.__private_fields__ if dict.__contains__(self, k)}
+
+    # 只序列化fields中的字段，不复制也不修改对象本身
+    def only(self, *fields):
+        return FieldSubset(self, fields)
+
     # 通过__getattr__和__setattr__方法使得能通过user.name的方式访问对象的属性
     # _getattr_用于查询不在__dict__系统中的属性
     def __getattr__(self, key):
@@ -172,20 +358,49 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
+    @classmethod
+    def query(cls):
+        """create a composable Query of this model."""
+        return Query(cls)
+
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
         """find object by where clause."""
-        sql = [cls.__select__]
+        # join参数为另一个Model类，会通过一条LEFT JOIN语句同时取出关联表中的字段
+        # 使用join时，where中两个表都有的字段需要加上表名，如'`comments`.`user_id`=?'
+        join = kw.get('join', None)
+        if join is None:
+            sql = [cls.__select__]
+        else:
+            on = kw.get('on', None) or '%s_id' % join.__name__.lower()
+            sql = [cls._joinSelect(join, on, kw.get('fields', None))]
         if where:
             sql.append('where')
             sql.append(where)
         if args is None:
             args = []
         orderBy = kw.get('orderBy', None)  # 语句中是否有orderBy参数
+        limit = kw.get('limit', None)  # 语句中是否有limit参数
+        # 有归档表时同时查询主表和归档表，since参数(时间戳)可以跳过更早月份的归档表
+        tables = cls._archiveTables(kw.get('since', None)) if kw.get('archived', True) else []
+        if tables:
+            top = None
+            if orderBy and isinstance(limit, int):
+                top = limit
+            elif orderBy and isinstance(limit, tuple) and len(limit) == 2:
+                top = limit[0] + limit[1]
+            if top is not None and cls._newestFirst(orderBy):
+                # 按创建时间倒序分页时，从主表开始逐个查询归档表，取够top行之后跳过更早的归档表
+                rs = await cls._selectNewest(' '.join(sql), args, tables, orderBy, top)
+                rs = rs[limit[0]:top] if isinstance(limit, tuple) else rs[:top]
+                if join is None:
+                    return [cls(**r) for r in rs]
+                return [cls._joinRow(join, r) for r in rs]
+            union, args = cls._union(' '.join(sql), args, tables, orderBy, top)
+            sql = [union]
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
-        limit = kw.get('limit', None)  # 语句中是否有limit参数
         if limit is not None:
             sql.append('limit')
             if isinstance(limit, int):
@@ -197,7 +412,104 @@ class Model(dict, metaclass=ModelMetaclass):
             else:
                 raise ValueError('Invalid limit value: %s ' % str(limit))
         rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        if join is None:
+            return [cls(**r) for r in rs]
+        return [cls._joinRow(join, r) for r in rs]
+
+    # 关联表的字段在结果中的别名前缀，如Blog表的name字段的别名为blog__name
+    @staticmethod
+    def _joinPrefix(join):
+        return '%s__' % join.__name__.lower()
+
+    # 构造 select ... from `cls` left join `join` on `cls`.`on`=`join`.`主键` 语句
+    # fields为需要取出的关联表字段，主键总是会被取出
+    @classmethod
+    def _joinSelect(cls, join, on, fields=None):
+        if on not in cls.__mappings__:
+            raise ValueError('Invalid join field: %s' % on)
+        if fields is None:
+            fields = join.__fields__
+        prefix = cls._joinPrefix(join)
+        columns = list(map(lambda f: '`%s`.`%s`' % (cls.__table__, f), [cls.__primary_key__] + cls.__fields__))
+        for f in [join.__primary_key__] + [f for f in fields if f != join.__primary_key__]:
+            if f not in join.__mappings__:
+                raise ValueError('Invalid field for %s: %s' % (join.__name__, f))
+            columns.append('`%s`.`%s` as `%s%s`' % (join.__table__, f, prefix, f))
+        return 'select %s from `%s` left join `%s` on `%s`.`%s`=`%s`.`%s`' % (
+            ', '.join(columns), cls.__table__, join.__table__,
+            cls.__table__, on, join.__table__, join.__primary_key__)
+
+    # 将带前缀的列拆分出来，生成嵌套的关联对象，如comment.blog.name
+    @classmethod
+    def _joinRow(cls, join, r):
+        prefix = cls._joinPrefix(join)
+        own = dict()
+        sub = dict()
+        for k, v in r.items():
+            if k.startswith(prefix):
+                sub[k[len(prefix):]] = v
+            else:
+                own[k] = v
+        obj = cls(**own)
+        # LEFT JOIN没有匹配到关联行时，主键为NULL
+        obj[join.__name__.lower()] = join(**sub) if sub.get(join.__primary_key__) is not None else None
+        return obj
+
+    # 返回需要查询的归档表，since不为None时只返回since所在月份及之后的归档表
+    @classmethod
+    def _archiveTables(cls, since=None):
+        if since is None or not cls.__archive_tables__:
+            return cls.__archive_tables__
+        month = time.strftime('%Y%m', time.localtime(since))
+        return [t for t in cls.__archive_tables__ if t[-6:] >= month]
+
+    # 排序是否只按created_at倒序，如'created_at desc'或'`comments`.`created_at` desc'
+    @classmethod
+    def _newestFirst(cls, orderBy):
+        parts = orderBy.replace('`', '').lower().split()
+        return 'created_at' in cls.__mappings__ and len(parts) == 2 and parts[1] == 'desc' \
+            and parts[0].rpartition('.')[2] == 'created_at'
+
+    # 归档表t中所有行的created_at都早于这个时间戳(下个月的月初)
+    @staticmethod
+    def _archiveEnd(t):
+        return time.mktime((int(t[-6:-2]), int(t[-2:]) + 1, 1, 0, 0, 0, 0, 0, -1))
+
+    # 按主表、从新到旧的归档表的顺序执行branch，每张表取前top行，
+    # 已经取到的前top行都不早于下一张归档表中最新的行时，不再查询更早的归档表
+    @classmethod
+    async def _selectNewest(cls, branch, args, tables, order, top):
+        table = '`%s`' % cls.__table__
+        rs = await select('%s order by %s limit %d' % (branch, order, int(top)), args)
+        for t in tables:
+            if len(rs) >= top and rs[top - 1]['created_at'] >= cls._archiveEnd(t):
+                break
+            sql = branch.replace('from %s' % table, 'from `%s` %s' % (t, table), 1)
+            rs.extend(await select('%s order by %s limit %d' % (sql, order, int(top)), args))
+            rs.sort(key=lambda r: r['created_at'], reverse=True)
+        return rs
+
+    # 将主表上的查询语句branch复制到每个归档表上(归档表使用主表名作为别名)，再用union all合并
+    # order和top不为None时，每个分支先排序并只取前top行，减少合并的行数
+    @classmethod
+    def _union(cls, branch, args, tables, order=None, top=None):
+        table = '`%s`' % cls.__table__
+        parts = [branch] + [branch.replace('from %s' % table, 'from `%s` %s' % (t, table), 1) for t in tables]
+        if order and top is not None:
+            parts = ['%s order by %s limit %d' % (p, order, int(top)) for p in parts]
+        return ' union all '.join(map(lambda p: '(%s)' % p, parts)), list(args) * len(parts)
+
+    # 在主表和所有归档表上执行同一条语句，返回影响的总行数
+    # first为True时，只要有一张表影响了行就停止，用于按主键操作
+    @classmethod
+    async def _executeArchived(cls, sql, args, first=False):
+        rows = await execute(sql, args)
+        table = '`%s`' % cls.__table__
+        for t in cls.__archive_tables__:
+            if first and rows:
+                break
+            rows += await execute(sql.replace(table, '`%s`' % t, 1), args)
+        return rows
 
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
@@ -208,7 +520,16 @@ class Model(dict, metaclass=ModelMetaclass):
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        sql = ' '.join(sql)
+        # 有归档表时，count()的结果为主表和各个归档表的count()之和
+        # 其他的聚合函数不能由各个表的结果合并，只查询主表会得到错误的结果，所以不支持
+        if cls.__archive_tables__:
+            if not selectField.strip().lower().startswith('count('):
+                raise ValueError('findNumber() only supports count() on archived model %s: %s'
+                                 % (cls.__name__, selectField))
+            union, args = cls._union(sql, args or [], cls.__archive_tables__)
+            sql = 'select sum(_num_) _num_ from (%s) t' % union
+        rs = await select(sql, args, 1)
         if len(rs) == 0:
             return None
         # rs[0]表示一行数据,是一个字典，而rs是一个列表
@@ -217,41 +538,353 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     async def find(cls, pk):
         """find object by primary key."""
-        rs = await select('%s where `%s`= ?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        sql = '%s where `%s`= ?' % (cls.__select__, cls.__primary_key__)
+        rs = await select(sql, [pk], 1)
+        if len(rs) == 0 and cls.__archive_tables__:
+            # 主表中没有找到时，再到归档表中查找
+            union, args = cls._union(sql, [pk], cls.__archive_tables__)
+            rs = await select(union, args, 1)
         if len(rs) == 0:
             return None
         # 1.将rs[0]转换成关键字参数元组，rs[0]为dict，格式为：{'id':1,'name':'wanzhiwen'}
         # 2.通过<class '__main__.User'>(位置参数元组)，产生一个实例对象
         return cls(**rs[0])
 
-    async def save(self):
+    @classmethod
+    async def findByIds(cls, pks, chunk_size=None):
+        """find objects by a list of primary keys."""
+        # 去掉重复的主键，保持传入的顺序
+        pks = list(dict.fromkeys(pks))
+        if chunk_size is None:
+            chunk_size = IN_CHUNK_SIZE
+        objs = dict()
+        # 每chunk_size个主键拼成一条 where `id` in (...) 语句，避免IN列表过长
+        for n in range(0, len(pks), chunk_size):
+            chunk = pks[n:n + chunk_size]
+            sql = '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(len(chunk)))
+            rs = await select(sql, chunk)
+            for r in rs:
+                objs[r[cls.__primary_key__]] = cls(**r)
+            # 只到归档表中查找主表中没有找到的主键
+            missing = [pk for pk in chunk if pk not in objs]
+            if missing and cls.__archive_tables__:
+                sql = '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(len(missing)))
+                sql, args = cls._union(sql, missing, cls.__archive_tables__)
+                for r in await select(sql, args):
+                    objs[r[cls.__primary_key__]] = cls(**r)
+        # 按照传入主键的顺序返回，不存在的主键直接跳过
+        return [objs[pk] for pk in pks if pk in objs]
+
+    @classmethod
+    async def deleteWhere(cls, where, args=None):
+        """delete rows by where clause, return affected rows."""
+        if not where:
+            raise ValueError('deleteWhere() requires a where clause.')
+        rows = await cls._executeArchived('delete from `%s` where %s' % (cls.__table__, where), args or [])
+        await touch(cls.__table__)
+        return rows
+
+    @classmethod
+    async def updateWhere(cls, set, where, args=None):
+        """update rows by set and where clause, return affected rows."""
+        if not where:
+            raise ValueError('updateWhere() requires a where clause.')
+        rows = await cls._executeArchived('update `%s` set %s where %s' % (cls.__table__, set, where), args or [])
+        await touch(cls.__table__)
+        return rows
+
+    @classmethod
+    async def saveAll(cls, objs, batch_size=None):
+        """insert objects in batches, return affected rows."""
+        return await cls._insertAll(objs, '', batch_size)
+
+    @classmethod
+    async def upsertAll(cls, objs, update_fields=None, batch_size=None):
+        """insert or update objects in batches, return affected rows."""
+        return await cls._insertAll(objs, ' ' + cls._upsertString(update_fields), batch_size)
+
+    # 检查update_fields并生成 on duplicate key update 子句，为None时更新所有非主键字段
+    @classmethod
+    def _upsertString(cls, update_fields=None):
+        if update_fields is None:
+            update_fields = cls.__fields__
+        update_fields = list(update_fields)
+        if not update_fields:
+            raise ValueError('update_fields of %s must not be empty.' % cls.__name__)
+        for f in update_fields:
+            if f not in cls.__fields__:
+                raise ValueError('Invalid update field for %s: %s' % (cls.__name__, f))
+        return create_upsert_string(update_fields)
+
+    # 每batch_size行拼成一条 insert ... values (...), (...) 语句，suffix为附加在语句最后的子句
+    @classmethod
+    async def _insertAll(cls, objs, suffix, batch_size=None):
+        if batch_size is None:
+            batch_size = BATCH_SIZE
+        row = '(%s)' % create_args_string(len(cls.__fields__) + 1)
+        affected = 0
+        for n in range(0, len(objs), batch_size):
+            chunk = objs[n:n + batch_size]
+            args = []
+            for obj in chunk:
+                args.extend(obj._insertArgs())
+            sql = 'insert into `%s` (%s, `%s`) values %s%s' % (
+                cls.__table__, ', '.join(map(lambda f: '`%s`' % f, cls.__fields__)), cls.__primary_key__,
+                ', '.join([row] * len(chunk)), suffix)
+            affected += await execute(sql, args)
+        await touch(cls.__table__)
+        return affected
+
+    # 按照__insert__语句中字段的顺序获取参数，主键放在最后
+    def _insertArgs(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
+        return self._compressArgs(args)
+
+    # 将参数中压缩字段的值替换成压缩后的bytes，args的顺序和__fields__相同
+    # 列还不是blob时(见load_column_types())保存原来的文本
+    def _compressArgs(self, args):
+        for k in self.__compressed__:
+            field = self.__mappings__[k]
+            if field.binary:
+                n = self.__fields__.index(k)
+                args[n] = field.compress(args[n])
+        return args
+
+    async def save(self):
+        args = self._insertArgs()
         rows = await execute(self.__insert__, args)
+        await touch(self.__table__, args[-1])
         if rows != 1:
             logging.warning('Failed to insert record: affected rows: %s' % rows)
 
+    async def upsert(self, update_fields=None):
+        # MySQL中插入新行时affected rows为1，更新已有的行时为2，没有变化时为0
+        if update_fields is None:
+            sql = self.__upsert__
+        else:
+            sql = '%s %s' % (self.__insert__, self._upsertString(update_fields))
+        args = self._insertArgs()
+        rows = await execute(sql, args)
+        await touch(self.__table__, args[-1])
+        if rows not in (0, 1, 2):
+            logging.warning('Failed to upsert record: affected rows: %s' % rows)
+        return rows
+
     async def update(self):
         args = list(map(self.getValue, self.__fields__))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await self._executeArchived(self.__update__, self._compressArgs(args), True)
+        await touch(self.__table__, args[-1])
         if rows != 1:
             logging.warning('Failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        rows = await self._executeArchived(self.__delete__, args, True)
+        await touch(self.__table__, args[0])
         if rows != 1:
             logging.warning('Failed to remove by primary key: affected rows: %s' % rows)
 
+# Model.only()的结果，序列化时只输出指定的字段
+class FieldSubset(object):
+    __slots__ = ('obj', 'fields')
+
+    def __init__(self, obj, fields):
+        self.obj = obj
+        self.fields = fields
+
+    def serialize(self):
+        obj = self.obj
+        return {k: obj[k] for k in self.fields if k not in obj.__private_fields__ and k in obj}
+
+
+# 查询条件中支持的运算符，如filter(created_at__gt=t)表示 `created_at`>?
+QUERY_OPERATORS = {
+    'eq': '=',
+    'ne': '<>',
+    'gt': '>',
+    'ge': '>=',
+    'lt': '<',
+    'le': '<=',
+    'like': ' like ',
+    'in': ' in '
+}
+# 缓存的SQL语句的最大数量
+PLAN_CACHE_SIZE = 256
+# 编译好的SQL语句缓存，key为查询的形状：表名、条件字段和运算符、排序、字段和索引提示，不包含参数的值
+_plan_cache = dict()
+
+# 可以组合的查询对象，通过Model.query()创建，例如：
+#   await Blog.query().filter(user_id=uid).orderBy('-created_at').limit(10).all()
+# 所有的字段名都会根据Model的__mappings__进行校验，形状相同的查询共用同一条编译好的SQL语句
+class Query(object):
+    def __init__(self, model):
+        self._model = model
+        self._where = []  # 每个条件为(字段, 运算符, IN列表的长度)
+        self._args = []
+        self._orderBy = []
+        self._limit = None
+        self._fields = None
+        self._index = None  # 索引提示，(use|force, 索引名)
+        self._archived = True  # 是否同时查询归档表
+        self._since = None
+
+    def _checkField(self, name):
+        if name not in self._model.__mappings__:
+            raise ValueError('Invalid field for %s: %s' % (self._model.__name__, name))
+        return name
+
+    def filter(self, **kw):
+        """add conditions like name=value or name__op=value, joined by and."""
+        for k in sorted(kw.keys()):
+            name, _, op = k.partition('__')
+            op = op or 'eq'
+            if op not in QUERY_OPERATORS:
+                raise ValueError('Invalid query operator: %s' % op)
+            value = kw[k]
+            if op == 'in':
+                value = list(value)
+                self._where.append((self._checkField(name), op, len(value)))
+                self._args.extend(value)
+            else:
+                self._where.append((self._checkField(name), op, None))
+                self._args.append(value)
+        return self
+
+    def orderBy(self, *names):
+        """order by fields, a leading '-' means desc."""
+        for name in names:
+            if name.startswith('-'):
+                self._orderBy.append((self._checkField(name[1:]), 'desc'))
+            else:
+                self._orderBy.append((self._checkField(name), 'asc'))
+        return self
+
+    def limit(self, limit, offset=None):
+        self._limit = (limit, offset)
+        return self
+
+    def fields(self, *names):
+        """only select the given fields, the primary key is always selected."""
+        pk = self._model.__primary_key__
+        self._fields = tuple([pk] + [self._checkField(n) for n in names if n != pk])
+        return self
+
+    def since(self, t):
+        """skip archive tables older than the month of timestamp t."""
+        self._since = t
+        return self
+
+    def hotOnly(self):
+        """only query the main table, skip all archive tables."""
+        self._archived = False
+        return self
+
+    def _tables(self):
+        return tuple(self._model._archiveTables(self._since)) if self._archived else ()
+
+    def useIndex(self, index):
+        self._index = ('use', index)
+        return self
+
+    def forceIndex(self, index):
+        self._index = ('force', index)
+        return self
+
+    def shape(self, count=False):
+        """the cache key of the query, which does not contain any argument value."""
+        return (self._model.__table__, count, tuple(self._where), tuple(self._orderBy),
+                None if self._limit is None else self._limit[1] is not None,
+                self._fields, self._index, self._tables())
+
+    def _compile(self, count):
+        model = self._model
+        if count:
+            columns = 'count(*) _num_'
+        elif self._fields is None:
+            columns = ', '.join(map(lambda f: '`%s`' % f, [model.__primary_key__] + model.__fields__))
+        else:
+            columns = ', '.join(map(lambda f: '`%s`' % f, self._fields))
+        tables = self._tables()
+        sql = ['select %s from `%s`' % (columns, model.__table__)]
+        if self._index:
+            sql.append('%s index (`%s`)' % self._index)
+        if self._where:
+            conditions = []
+            for name, op, n in self._where:
+                if op != 'in':
+                    conditions.append('`%s`%s?' % (name, QUERY_OPERATORS[op]))
+                elif n == 0:
+                    # 空的IN列表不会匹配任何行
+                    conditions.append('1=0')
+                else:
+                    conditions.append('`%s` in (%s)' % (name, create_args_string(n)))
+            sql.append('where')
+            sql.append(' and '.join(conditions))
+        if tables:
+            sql = [model._union(' '.join(sql), [], tables)[0]]
+            if count:
+                sql = ['select sum(_num_) _num_ from (%s) t' % sql[0]]
+        if self._orderBy and not count:
+            sql.append('order by')
+            sql.append(', '.join(map(lambda o: '`%s` %s' % o, self._orderBy)))
+        if self._limit is not None and not count:
+            sql.append('limit ?' if self._limit[1] is None else 'limit ?,?')
+        return ' '.join(sql)
+
+    def sql(self, count=False):
+        """return the normalized sql, compiled once per shape."""
+        key = self.shape(count)
+        sql = _plan_cache.get(key)
+        if sql is None:
+            if len(_plan_cache) >= PLAN_CACHE_SIZE:
+                _plan_cache.clear()
+            sql = self._compile(count)
+            _plan_cache[key] = sql
+        return sql
+
+    def args(self, count=False):
+        args = list(self._args) * (len(self._tables()) + 1)
+        if self._limit is not None and not count:
+            limit, offset = self._limit
+            if offset is not None:
+                args.append(offset)
+            args.append(limit)
+        return args
+
+    async def all(self):
+        rs = await select(self.sql(), self.args())
+        return [self._model(**r) for r in rs]
+
+    async def first(self):
+        # SQL中加上limit 1(保留已有的offset)，数据库只返回一行，不需要读取整个结果
+        limit = self._limit
+        self._limit = (1, None if limit is None else limit[1])
+        try:
+            sql, args = self.sql(), self.args()
+        finally:
+            self._limit = limit
+        rs = await select(sql, args, 1)
+        if len(rs) == 0:
+            return None
+        return self._model(**rs[0])
+
+    async def count(self):
+        rs = await select(self.sql(True), self.args(True), 1)
+        return rs[0]['_num_']
+
+
 # 定义Field类，负责保存(数据库)表的字段名和字段类型
 class Field(object):
     # 表的字段包含名字、类型、是否为表的主键和默认值
-    def __init__(self, name, column_type, primary_key, default):
+    # private为True的字段(如密码)不会出现在序列化的结果中
+    def __init__(self, name, column_type, primary_key, default, private=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.private = private
 
     # 当打印(数据库)表时，输出(数据库)表的信息:类名，字段类型和名字
     def __str__(self):
@@ -259,8 +892,8 @@ class Field(object):
 
 
 class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', private=False):
+        super().__init__(name, ddl, primary_key, default, private)
 
 class BooleanField(Field):
 
@@ -281,3 +914,51 @@ class FloatField(Field):
 class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
+
+# 压缩存储的长文本字段，数据库中的列类型为blob
+# 保存时第一个字节标记存储格式：0为未压缩的utf-8文本，1为zlib，2为zstd
+class CompressedTextField(Field):
+    PLAIN = b'\x00'
+    ZLIB = b'\x01'
+    ZSTD = b'\x02'
+
+    def __init__(self, name=None, default=None, algorithm='zlib', level=6, min_size=256, ddl='mediumblob'):
+        if algorithm not in ('zlib', 'zstd'):
+            raise ValueError('Invalid compression algorithm: %s' % algorithm)
+        if algorithm == 'zstd' and zstandard is None:
+            logging.warning('zstandard is not installed, use zlib instead.')
+            algorithm = 'zlib'
+        super().__init__(name, ddl, False, default)
+        self.algorithm = algorithm
+        self.level = level
+        # 小于min_size字节的文本压缩后反而可能更大，直接存储
+        self.min_size = min_size
+        # 数据库中的列是否已经是blob，由load_column_types()设置，为False时不压缩
+        self.binary = False
+
+    def compress(self, value):
+        if value is None or isinstance(value, (bytes, bytearray)):
+            return value
+        data = value.encode('utf-8')
+        if len(data) < self.min_size:
+            return self.PLAIN + data
+        if self.algorithm == 'zstd':
+            return self.ZSTD + zstandard.ZstdCompressor(level=self.level).compress(data)
+        return self.ZLIB + zlib.compress(data, self.level)
+
+    def decompress(self, value):
+        # 还没有迁移的行从text列中读出来的就是str
+        if value is None or isinstance(value, str):
+            return value
+        value = bytes(value)
+        flag, data = value[:1], value[1:]
+        if flag == self.ZLIB:
+            data = zlib.decompress(data)
+        elif flag == self.ZSTD:
+            if zstandard is None:
+                raise RuntimeError('zstandard is required to read zstd compressed field.')
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif flag != self.PLAIN:
+            # 没有标记的bytes当作未压缩的utf-8文本
+            data = value
+        return data.decode('utf-8')
@@ -5,24 +5,39 @@ import functools
 import inspect
 import logging
 import os
+import json
+import hmac
+import base64
 import hashlib
 import time
-import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from jinja2 import Environment, FileSystemLoader
-from urllib import parse
+from email.utils import formatdate, parsedate_to_datetime
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from aiohttp import web
 
 try:
     from apis import APIError
     from config import configs
     from models import User, Comment, Blog, next_id
+    import orm
+    from orm import listen
+    import serializer
+    import assets
+    from compression import add_vary
 except ImportError:
     raise ImportError('The file is not found. Please check the file name!')
 
 
 # 装饰器，用于获取GET提交的路径和参数
-def get(path):
+# version为version(request)函数，返回响应内容的版本号，用于条件GET，见response_factory
+# stream为True时模板边渲染边输出，用于很大的页面
+# offload为True时，数据很多的页面在线程池中渲染模板，见render_template()
+# auth为False时不解析cookie，log为False时logger_factory不记录请求日志(访问日志仍然记录)，
+# None表示使用add_routes()的设置，见route_option()
+def get(path, *, version=None, stream=False, offload=False, auth=None, log=None):
     """
     Define decorator @get('/path')
     """
@@ -34,13 +49,18 @@ def get(path):
 
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
+        wrapper.__version__ = version
+        wrapper.__stream__ = stream
+        wrapper.__offload__ = offload
+        wrapper.__auth__ = auth
+        wrapper.__log__ = log
         return wrapper
 
     return decorator
 
 
-# 装饰器，用于获取POST提交的路径和参数
-def post(path):
+# 装饰器，用于获取POST提交的路径和参数，auth和log同@get
+def post(path, *, auth=None, log=None):
     """
     Define decorator @post('/path')
     """
@@ -52,6 +72,8 @@ def post(path):
 
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
+        wrapper.__auth__ = auth
+        wrapper.__log__ = log
         return wrapper
 
     return decorator
@@ -115,8 +137,10 @@ def has_request_arg(fn):
 
 # RequestHandler目的就是从URL处理函数（如handlers.index）中分析其需要接收的参数，从web.request对象中获取必要的参数，
 # 调用URL处理函数，然后把结果转换为web.Response对象，这样，就完全符合aiohttp框架的要求
+# 参数的分析在注册URL处理函数时只做一次，_compile()根据分析的结果生成专门用于这个函数的参数绑定函数，
+# 处理请求时不再逐项判断
 class RequestHandler(object):
-    def __init__(self, app, fn):
+    def __init__(self, app, fn, path=None, auth=True, log=True):
         self._app = app
         self._func = fn
         self._has_request_arg = has_request_arg(fn)
@@ -124,16 +148,43 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
-
-    # 1.定义kw对象，用于保存参数
-    # 2.判断URL处理函数是否存在参数，如果存在则根据是POST还是GET方法将request请求内容保存到kw
-    # 3.如果kw为空(说明request没有请求内容)，则将match_info列表里面的资源映射表赋值给kw；如果不为空则把命名关键字参数的内容给kw
-    # 4.完善_has_request_arg和_required_kw_args属性
-    async def __call__(self, request):
-        kw = None
-        # 如果有需要处理的参数
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            # POST提交的参数可以直接获取
+        # path为None时不知道URL中是否有{name}形式的参数，按有参数处理
+        self._has_match_info = path is None or '{' in path
+        # 条件GET使用的版本号函数，response_factory通过request.match_info.handler获取
+        self.version = getattr(fn, '__version__', None)
+        self.stream = getattr(fn, '__stream__', False)
+        self.offload = getattr(fn, '__offload__', False)
+        # auth_factory和logger_factory的选项，@get/@post没有指定时使用add_routes()的设置
+        self.auth = auth if getattr(fn, '__auth__', None) is None else fn.__auth__
+        self.log = log if getattr(fn, '__log__', None) is None else fn.__log__
+        self._call = self._compile()
+
+    def _compile(self):
+        fn = self._func
+        has_request_arg = self._has_request_arg
+        if not (self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args):
+            # URL处理函数没有关键字参数，只需要URL中的参数和request
+            if not self._has_match_info:
+                if has_request_arg:
+                    return lambda request: fn(request=request)
+                return lambda request: fn()
+
+            def call_with_match_info(request):
+                kw = dict(**request.match_info)
+                if has_request_arg:
+                    kw['request'] = request
+                return fn(**kw)
+            return call_with_match_info
+
+        named_kw_args = self._named_kw_args if not self._has_var_kw_arg else None
+        required_kw_args = self._required_kw_args
+        has_match_info = self._has_match_info
+
+        # 1.POST请求从body中获取参数，GET请求从查询字符串中获取参数
+        # 2.没有**kw参数时，只保留URL处理函数的命名关键字参数
+        # 3.合并URL中的参数，并检查必须的关键字参数
+        async def call(request):
+            kw = None
             if request.method == 'POST':
                 if not request.content_type:
                     return web.HTTPBadRequest('Missing Content-Type.')
@@ -142,69 +193,49 @@ class RequestHandler(object):
                     params = await request.json()
                     if not isinstance(params, dict):
                         return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
                 elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
                     params = await request.post()
-                    kw = dict(**params)
                 else:
                     return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    # 解析url中?后面的键值对内容并保存到request_content
-                    '''
-                    qs = 'first=f,s&second=s'
-                    parse.parse_qs(qs, True).items()
-                    >>> dict([('first', ['f,s']), ('second', ['s'])])
-                    '''
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            # 参数为空说明没有从request对象中获取到参数,或者URL处理函数没有参数
-            '''
-            def hello(request):
-                    text = '<h1>hello, %s!</h1>' % request.match_info['name']
-                    return web.Response()
-            app.router.add_route('GET', '/hello/{name}', hello)
-            '''
-            '''if not self._has_var_kw_arg and not self._has_kw_arg and not self._required_kw_args:
-                # 当URL处理函数没有参数时，将request.match_info设为空，防止调用出错
-                request_content = dict()
-            '''
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw， 从request_content中删除URL处理函数中所有不需要的参数
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg: 检查关键字参数的名字是否和match_info中的重复
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        # 将request参数添加到kw字典中
-        if self._has_request_arg:
-            kw['request'] = request
-        # check required kw: 检查是否有必须关键字参数
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
+                if named_kw_args:
+                    kw = {name: params[name] for name in named_kw_args if name in params}
+                else:
+                    kw = dict(**params)
+            elif request.method == 'GET' and request.query_string:
+                # request.query为解析后的url中?后面的键值对，同一个key有多个值时取第一个
+                query = request.query
+                if named_kw_args:
+                    kw = {name: query[name] for name in named_kw_args if name in query}
+                else:
+                    kw = {k: query[k] for k in query.keys()}
+            if kw is None:
+                kw = dict(**request.match_info) if has_match_info else dict()
+            elif has_match_info:
+                # check named arg: 检查关键字参数的名字是否和match_info中的重复
+                for k, v in request.match_info.items():
+                    if k in kw:
+                        logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                    kw[k] = v
+            if has_request_arg:
+                kw['request'] = request
+            # check required kw: 检查是否有必须关键字参数
+            for name in required_kw_args:
+                if name not in kw:
                     return web.HTTPBadRequest('Missing argument: %s' % name)
-        # 以上代码均是为了获取调用参数
-        logging.info('call with args: %s' % str(kw))  # 打印所有的参数
+            logging.debug('call with args: %s', kw)
+            return await fn(**kw)
+        return call
+
+    async def __call__(self, request):
         try:
-            r = await self._func(**kw)  # 将请求的url后面带上的参数作为函数fn的参数，等待函数fn的执行结果
+            r = await self._call(request)  # 将请求中的参数作为函数fn的参数，等待函数fn的执行结果
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
 
-# 对单个函数进行注册
-def add_route(app, fn):
+# 对单个函数进行注册，auth和log为这个函数的@get/@post没有指定时的默认值
+def add_route(app, fn, auth=True, log=True):
     # 经过装饰器的装饰后，可以用__method__与__route__来获取请求的方法和路径
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__route__', None)
@@ -220,17 +251,40 @@ def add_route(app, fn):
         'add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
     # 正式注册为对应的url处理函数
     # RequestHandler类的实例是一个可以被call的函数
-    app.router.add_route(method, path, RequestHandler(app, fn))   # 注册处理函数
+    app.router.add_route(method, path, RequestHandler(app, fn, path, auth, log))   # 注册处理函数
 
 
 # 添加CSS等静态文件所在路径
-def add_static(app):
+# 静态文件不需要登录，默认也不记录请求日志
+def add_static(app, auth=False, log=False):
     # 获取当前文件所在的文件夹下的static文件夹的路径
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
     app.router.add_static('/static/', path)  # 添加静态文件
+    add_route_group(app, '/static/', auth=auth, log=log)
     logging.info('add static %s => %s' % ('/static/', path))
 
-def add_routes(app, module_name):
+# 为不是由RequestHandler处理的路径(如静态文件)设置auth_factory和logger_factory的选项
+def add_route_group(app, prefix, **options):
+    if '__route_groups__' not in app:
+        app['__route_groups__'] = []
+    app['__route_groups__'].append((prefix, options))
+
+# 路由的选项：URL处理函数的选项由@get/@post和add_routes()决定，其他的路径由add_route_group()决定，默认为True
+# 没有匹配到路由的请求(如favicon.ico)不需要登录，也不记录请求日志
+def route_option(request, name):
+    match_info = request.match_info
+    value = getattr(match_info.handler, name, None)
+    if value is not None:
+        return value
+    if getattr(match_info, 'http_exception', None) is not None:
+        return False
+    for prefix, options in request.app.get('__route_groups__', ()):
+        if request.path.startswith(prefix):
+            return options.get(name, True)
+    return True
+
+# auth和log为模块中所有URL处理函数的默认选项
+def add_routes(app, module_name, auth=True, log=True):
     # rfind()函数的作用是返回'.'在字符串module_name中最大的索引,返回-1则表示没找到'.'符号
     n = module_name.rfind('.')
     if n == (-1):
@@ -249,12 +303,14 @@ def add_routes(app, module_name):
             method = getattr(fn, '__method__', None)
             path = getattr(fn, '__route__', None)
             if method and path:
-                add_route(app, fn)
+                add_route(app, fn, auth, log)
 
 # 在调用方法之前，用日志记录请求的方法(GET或者POST)以及路径
 async def logger_factory(app, handler):
     async def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
+        if not route_option(request, 'log'):
+            return (await handler(request))
+        logging.debug('Request: %s %s', request.method, request.path)
         # await asyncio.sleep(0.3)
         return (await handler(request))
     return logger
@@ -266,10 +322,10 @@ async def data_factory(app, handler):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
                 request.__data__ = await request.json()
-                logging.info('request json: %s' % str(request.__data__))
+                logging.debug('request json: %s', request.__data__)
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = await request.post()
-                logging.info('request form: %s' % str(request.__data__))
+                logging.debug('request form: %s', request.__data__)
         return (await handler(request))
     return parse_data
 
@@ -277,15 +333,18 @@ COOKIE_NAME = 'myblogsession'
 _COOKIE_KEY = configs.secret
 async def auth_factory(app, handler):
     async def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
         request.__user__ = None
-        # 从request中根据cookie的名字获取cookies
-        cookie_str = request.cookies.get(COOKIE_NAME)
+        # 静态文件和公开的API不需要知道当前用户，不解析cookie
+        cookie_str = request.cookies.get(COOKIE_NAME) if route_option(request, 'auth') else None
         if cookie_str:
-            # 解析cookie，获取user对象
-            user = await cookie2user(cookie_str)
+            logging.debug('check user: %s %s', request.method, request.path)
+            # 解析cookie，获取user对象，签名的令牌不需要查询数据库
+            if cookie_str.startswith(TOKEN_PREFIX):
+                user = await token2user(cookie_str)
+            else:
+                user = await cookie2user(cookie_str)
             if user:  # 如果user不为None，表明这个cookie有效，则将user绑定到request对象中
-                logging.info('set current user: %s' % user.email)
+                logging.debug('set current user: %s', user.id)
                 request.__user__ = user
         # 管理页面需要管理员权限才允许访问
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
@@ -293,13 +352,171 @@ async def auth_factory(app, handler):
         return (await handler(request))
     return auth
 
-# 对cookie进行解析
+# ---------------------------------会话缓存---------------------------------
+# 验证过的cookie和对应的用户缓存在内存中，同一个cookie的后续请求不再查询数据库
+# 缓存最多保存SESSION_CACHE_SIZE个cookie(LRU)，每个最多保存SESSION_CACHE_TTL秒，并且不超过cookie本身的过期时间
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 300
+# cookie => (缓存的过期时间, User)
+_sessions = OrderedDict()
+# uid => 这个用户被缓存的cookie
+_user_sessions = dict()
+session_stats = dict(hits=0, misses=0)
+
+
+def init_session(configs):
+    global SESSION_CACHE_SIZE, SESSION_CACHE_TTL, TOKEN_CHECK_TTL
+    SESSION_CACHE_SIZE = configs.get('session_cache_size', SESSION_CACHE_SIZE)
+    SESSION_CACHE_TTL = configs.get('session_cache_ttl', SESSION_CACHE_TTL)
+    TOKEN_CHECK_TTL = configs.get('token_check_ttl', TOKEN_CHECK_TTL)
+
+
+def cache_session(cookie_str, user, expires):
+    if SESSION_CACHE_SIZE <= 0:
+        return
+    _sessions[cookie_str] = (min(expires, time.time() + SESSION_CACHE_TTL), user)
+    _user_sessions.setdefault(user.id, set()).add(cookie_str)
+    while len(_sessions) > SESSION_CACHE_SIZE:
+        invalidate_session(next(iter(_sessions)))
+
+
+def invalidate_session(cookie_str):
+    entry = _sessions.pop(cookie_str, None)
+    if entry is not None:
+        cookies = _user_sessions.get(entry[1].id)
+        if cookies is not None:
+            cookies.discard(cookie_str)
+            if not cookies:
+                del _user_sessions[entry[1].id]
+
+
+def invalidate_user(uid):
+    """
+    Drop cached sessions of user uid, or all cached sessions if uid is None.
+    """
+    if uid is None:
+        _sessions.clear()
+        _user_sessions.clear()
+        return
+    for cookie_str in _user_sessions.pop(uid, ()):
+        _sessions.pop(cookie_str, None)
+
+
+# 用户被修改(如密码或者管理员权限)时，删除缓存的会话，下次请求重新验证cookie
+listen(User, invalidate_user)
+
+
+def session_cache_stats():
+    total = session_stats['hits'] + session_stats['misses']
+    return dict(session_stats, size=len(_sessions), hit_rate=session_stats['hits'] / total if total else 0.0)
+
+
+# ---------------------------------签名的会话令牌---------------------------------
+# 令牌格式：v2.<声明>.<签名>，声明为base64编码的JSON，包含渲染页面需要的用户信息、过期时间、签发时间和代数，
+# 签名为声明的HMAC-SHA256，验证时不需要查询数据库
+# 配置中的session_generation为令牌的代数，修改之后重启，之前签发的令牌全部失效
+# 单个用户的令牌通过users.token_gen撤销：令牌中保存签发时的token_gen，和数据库中的不同时令牌无效，
+# 撤销的是这个用户所有的令牌，所以只用于修改用户和在所有设备上登出(/signout?everywhere=1)，普通的登出只删除cookie
+# 每个用户的token_gen在内存中最多缓存TOKEN_CHECK_TTL秒，其他进程撤销的令牌最多在这么长时间之后失效
+TOKEN_PREFIX = 'v2.'
+TOKEN_CLAIMS = ('id', 'name', 'image', 'admin')
+TOKEN_CHECK_TTL = 60
+_TOKEN_KEY = configs.secret.encode('utf-8')
+SESSION_GENERATION = configs.get('session_generation', 0)
+# uid => (缓存的过期时间, users.token_gen)
+_token_gens = OrderedDict()
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(s):
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+
+def _sign(payload):
+    return _b64encode(hmac.new(_TOKEN_KEY, payload.encode('ascii'), hashlib.sha256).digest())
+
+
+def user2token(user, max_age):
+    """
+    Generate a signed session token carrying the claims of user.
+    """
+    now = time.time()
+    claims = dict((k, user[k]) for k in TOKEN_CLAIMS)
+    claims.update(exp=int(now + max_age), iat=now, gen=SESSION_GENERATION, tgen=user.get('token_gen') or 0)
+    payload = _b64encode(json.dumps(claims, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    return '%s%s.%s' % (TOKEN_PREFIX, payload, _sign(payload))
+
+
+async def token2user(token):
+    """
+    Verify a signed session token and build the user from its claims, return None if it is invalid or revoked.
+    """
+    try:
+        payload, sig = token[len(TOKEN_PREFIX):].split('.')
+        if not hmac.compare_digest(sig, _sign(payload)):
+            logging.info('invalid token signature')
+            return None
+        claims = json.loads(_b64decode(payload).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if claims.get('gen') != SESSION_GENERATION or claims.get('exp', 0) < time.time():
+        return None
+    if claims.get('tgen') != await token_generation(claims.get('id')):
+        return None
+    return User(**dict((k, claims.get(k)) for k in TOKEN_CLAIMS))
+
+
+# 用户当前的token_gen，用户不存在时为None
+async def token_generation(uid):
+    entry = _token_gens.get(uid)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+    gen = await User.findNumber('`token_gen`', '`id`=?', [uid])
+    _token_gens[uid] = (time.time() + TOKEN_CHECK_TTL, gen)
+    _token_gens.move_to_end(uid)
+    while len(_token_gens) > SESSION_CACHE_SIZE:
+        _token_gens.popitem(last=False)
+    return gen
+
+
+def forget_token_generation(uid):
+    if uid is None:
+        _token_gens.clear()
+    else:
+        _token_gens.pop(uid, None)
+
+
+async def revoke_user(uid):
+    """
+    Revoke all tokens issued to user uid, in this and every other process.
+    """
+    # token_gen不影响页面的内容，不需要通过touch()改变users的版本号
+    await orm.execute('update `users` set `token_gen`=`token_gen`+1 where `id`=?', [uid])
+    forget_token_generation(uid)
+
+
+# 用户被修改时(User.update()会增加token_gen)，重新从数据库读取token_gen
+listen(User, forget_token_generation)
+
+
+# 对cookie进行解析，验证通过的用户放入会话缓存
 async def cookie2user(cookie_str):
     """
     Parse cookie and load user if cookie is valid.
     """
     if not cookie_str:
         return None
+    entry = _sessions.get(cookie_str)
+    if entry is not None:
+        if entry[0] > time.time():
+            _sessions.move_to_end(cookie_str)
+            session_stats['hits'] += 1
+            return entry[1]
+        invalidate_session(cookie_str)
+    session_stats['misses'] += 1
     try:
         L = cookie_str.split('-')
         if len(L) != 3:
@@ -315,7 +532,9 @@ async def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
-        user.passwd = '********'
+        # 缓存的用户不保存密码
+        user.passwd = '******'
+        cache_session(cookie_str, user, int(expires))
         return user
     except Exception as e:
         logging.exception(e)
@@ -333,42 +552,242 @@ async def cookie2user(cookie_str):
 # 注：在response_factory中应用了jinja2来渲染模板文件
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('Response handler...')
+        logging.debug('Response handler...')
+        headers = None
+        version = getattr(request.match_info.handler, 'version', None)
+        if version is not None and request.method in ('GET', 'HEAD'):
+            headers = await conditional_headers(request, version)
+            # 客户端缓存的内容没有变化，不调用URL处理函数，也不渲染模板和序列化
+            if headers is not None and not_modified(request, headers):
+                return web.HTTPNotModified(headers=headers)
         r = await handler(request)
-        if isinstance(r, web.StreamResponse):
-            return r
-        if isinstance(r, bytes):
-            resp = web.Response(body=r)
-            resp.content_type = 'application/octet-stream'
+        resp = await make_response(app, request, r, headers)
+        if headers is not None and resp.status == 200 and not resp.prepared:
+            resp.headers.update(headers)
+        return resp
+    return response
+
+# 将URL处理函数的返回值转换为web.Response对象，headers为分块输出时需要在prepare()之前设置的响应头
+async def make_response(app, request, r, headers=None):
+    if isinstance(r, web.StreamResponse):
+        return r
+    if isinstance(r, bytes):
+        resp = web.Response(body=r)
+        resp.content_type = 'application/octet-stream'
+        return resp
+    if isinstance(r, str):
+        if r.startswith('redirect:'):
+            return web.HTTPFound(r[9:])
+        resp = web.Response(body=r.encode('utf-8'))
+        resp.content_type = 'text/html;charset=utf-8'
+        return resp
+    if isinstance(r, dict):
+        template = r.get('__template__')
+        if template is None:
+            # 很长的列表分块序列化并输出，不需要在内存中生成完整的JSON
+            key = serializer.large_list_key(r)
+            if key is not None:
+                resp = web.StreamResponse(headers=headers)
+                resp.content_type = 'application/json'
+                resp.charset = 'utf-8'
+                # 分块输出的响应不经过compression_factory，由aiohttp按Accept-Encoding压缩
+                resp.enable_compression()
+                add_vary(resp, 'Accept-Encoding')
+                await resp.prepare(request)
+                for chunk in serializer.iter_dumps(r, key):
+                    await resp.write(chunk)
+                await resp.write_eof()
+                return resp
+            resp = web.Response(body=serializer.dumps(r))
+            resp.content_type = 'application/json;charset=utf-8'
             return resp
-        if isinstance(r, str):
-            if r.startswith('redirect:'):
-                return web.HTTPFound(r[9:])
-            resp = web.Response(body=r.encode('utf-8'))
+        elif getattr(request.match_info.handler, 'stream', False):
+            return await stream_template(app, request, template, r, headers)
+        else:
+            # 使用模板对网页进行渲染
+            resp = web.Response(body=await render_template(app, request, template, r))
             resp.content_type = 'text/html;charset=utf-8'
             return resp
-        if isinstance(r, dict):
-            template = r.get('__template__')
-            if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset=utf-8'
-                return resp
-            else:
-                # 使用模板对网页进行渲染
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                resp.content_type = 'text/html;charset=utf-8'
-                return resp
-        if isinstance(r, int) and r >= 100 and r < 600:
-            return web.Response(r)
-        if isinstance(r, tuple) and len(r) == 2:
-            t, m = r
-            if isinstance(t, int) and t >= 100 and t < 600:
-                return web.Response(t, str(m))
-        # default,默认是纯文本文件:
-        resp = web.Response(body=str(r).encode('utf-8'))
-        resp.content_type = 'text/plain;charset=utf-8'
-        return resp
-    return response
+    if isinstance(r, int) and r >= 100 and r < 600:
+        return web.Response(r)
+    if isinstance(r, tuple) and len(r) == 2:
+        t, m = r
+        if isinstance(t, int) and t >= 100 and t < 600:
+            return web.Response(t, str(m))
+    # default,默认是纯文本文件:
+    resp = web.Response(body=str(r).encode('utf-8'))
+    resp.content_type = 'text/plain;charset=utf-8'
+    return resp
+
+# 分块渲染模板时，每积累这么多字符输出一次
+TEMPLATE_CHUNK_SIZE = 8192
+
+# 使用generate()分块渲染模板，渲染的同时输出已经生成的部分，页面的开头不需要等到整个页面渲染完成
+# 响应已经开始输出，所以由aiohttp负责压缩
+async def stream_template(app, request, template, r, headers=None):
+    resp = web.StreamResponse(headers=headers)
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    resp.enable_compression()
+    add_vary(resp, 'Accept-Encoding')
+    await resp.prepare(request)
+    parts = app['__templating__'].get_template(template).generate(**r)
+    executor = _render_executor if should_offload(request, r) else None
+    elapsed = 0.0
+    while True:
+        if executor is None:
+            chunk, t = next_chunk(parts)
+        else:
+            chunk, t = await asyncio.get_event_loop().run_in_executor(executor, next_chunk, parts)
+        elapsed += t
+        if chunk is None:
+            break
+        await resp.write(chunk)
+    record_render('inline' if executor is None else 'offload', elapsed)
+    await resp.write_eof()
+    return resp
+
+
+# 从generate()的结果中取出至少TEMPLATE_CHUNK_SIZE个字符，返回(编码后的bytes, 耗时)，已经渲染完成时bytes为None
+def next_chunk(parts):
+    start = time.perf_counter()
+    buf = []
+    size = 0
+    for part in parts:
+        buf.append(part)
+        size += len(part)
+        if size >= TEMPLATE_CHUNK_SIZE:
+            break
+    chunk = ''.join(buf).encode('utf-8') if buf else None
+    return chunk, time.perf_counter() - start
+
+# ------------------------------在线程池中渲染模板------------------------------
+# 模板渲染是CPU密集的同步操作，在事件循环中渲染很大的页面时，其他请求都要等待
+# 路由使用@get(path, offload=True)并且数据足够多时，在线程池中渲染
+
+# 渲染模板的线程池，由init_render()根据配置创建，为None时所有模板都在事件循环中渲染
+_render_executor = None
+# 模板参数中各个列表的元素个数之和不小于这个值时，才在线程池中渲染
+RENDER_OFFLOAD_SIZE = 100
+# 渲染的统计：kind => [次数, 总耗时, 最长耗时]，inline在事件循环中渲染，offload在线程池中渲染
+render_stats = dict(inline=[0, 0.0, 0.0], offload=[0, 0.0, 0.0])
+_stats_lock = threading.Lock()
+
+
+def init_render(configs):
+    global _render_executor, RENDER_OFFLOAD_SIZE
+    RENDER_OFFLOAD_SIZE = configs.get('render_offload_size', RENDER_OFFLOAD_SIZE)
+    threads = configs.get('render_threads', 0)
+    if threads and _render_executor is None:
+        _render_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='render')
+        logging.info('render templates in %s threads, offload size: %s' % (threads, RENDER_OFFLOAD_SIZE))
+
+
+# 估计页面的大小：模板参数中所有列表的元素个数之和，如博文的评论数
+def size_hint(r):
+    return sum(len(v) for v in r.values() if isinstance(v, (list, tuple)))
+
+
+def should_offload(request, r):
+    return _render_executor is not None and getattr(request.match_info.handler, 'offload', False) \
+        and size_hint(r) >= RENDER_OFFLOAD_SIZE
+
+
+def record_render(kind, elapsed):
+    with _stats_lock:
+        stats = render_stats[kind]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+
+def _render(template, r):
+    start = time.perf_counter()
+    body = template.render(**r).encode('utf-8')
+    return body, time.perf_counter() - start
+
+
+async def render_template(app, request, template, r):
+    """
+    Render template with r into bytes, in the render thread pool if the route opts in and the page is large.
+    """
+    template = app['__templating__'].get_template(template)
+    if should_offload(request, r):
+        body, elapsed = await asyncio.get_event_loop().run_in_executor(_render_executor, _render, template, r)
+        record_render('offload', elapsed)
+    else:
+        body, elapsed = _render(template, r)
+        record_render('inline', elapsed)
+    return body
+
+
+async def watch_render(interval=60, tick=0.1):
+    """
+    Log render stats, the max event loop lag and session cache stats every interval seconds.
+    """
+    loop = asyncio.get_event_loop()
+    last = loop.time()
+    max_lag = 0.0
+    while True:
+        # 事件循环被阻塞时，sleep()实际等待的时间会超过tick
+        start = loop.time()
+        await asyncio.sleep(tick)
+        now = loop.time()
+        max_lag = max(max_lag, now - start - tick)
+        if now - last < interval:
+            continue
+        with _stats_lock:
+            report = ', '.join('%s: %d, avg %.1fms, max %.1fms' % (
+                kind, n, total / n * 1000 if n else 0, longest * 1000) for kind, (n, total, longest) in render_stats.items())
+            for stats in render_stats.values():
+                stats[:] = [0, 0.0, 0.0]
+        logging.info('render %s; event loop max lag: %.1fms' % (report, max_lag * 1000))
+        stats = session_cache_stats()
+        logging.info('session cache: %s sessions, hits: %s, misses: %s, hit rate: %.1f%%'
+                     % (stats['size'], stats['hits'], stats['misses'], stats['hit_rate'] * 100))
+        last = now
+        max_lag = 0.0
+
+# 条件GET的响应头：version(request)返回版本号，或者(版本号, 最后修改时间)，返回None表示不使用条件GET
+# 页面中会显示当前登录的用户，所以ETag由版本号、用户以及模板和静态文件的版本(见build_id())共同决定
+async def conditional_headers(request, version):
+    key = version(request)
+    if inspect.isawaitable(key):
+        key = await key
+    if key is None:
+        return None
+    last_modified = None
+    if isinstance(key, tuple):
+        key, last_modified = key
+    user = request.__user__
+    tag = hashlib.md5(('%s:%s:%s' % (request.app.get('__build_id__', ''), key, user.id if user else ''))
+                      .encode('utf-8')).hexdigest()
+    # 响应经过压缩后字节会变化，所以使用弱ETag；no-cache要求客户端每次都用条件GET验证缓存
+    headers = {'ETag': 'W/"%s"' % tag, 'Cache-Control': 'no-cache', 'Vary': 'Cookie'}
+    if last_modified is not None:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    return headers
+
+# 判断客户端缓存的内容是否仍然有效，同时有If-None-Match和If-Modified-Since时只比较ETag
+def not_modified(request, headers):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        etag = headers['ETag'][2:]
+        for t in if_none_match.split(','):
+            t = t.strip()
+            if t.startswith('W/'):
+                t = t[2:]
+            if t == '*' or t == etag:
+                return True
+        return False
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is None or 'Last-Modified' not in headers:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return False
+    return int(parsedate_to_datetime(headers['Last-Modified']).timestamp()) <= since
 
 # 用于显示时间戳参数t与当前时间的差值
 def datetime_filter(t):
@@ -399,8 +818,12 @@ def init__jinja2(app, **kw):
         variable_start_string=kw.get('variable_start_string', '{{'),
         variable_end_string=kw.get('variable_end_string', '}}'),
         # 当模板文件被修改后，下次请求加载该模板文件的时候会自动重新加载修改后的模板文件
+        # 每次get_template()都要检查模板文件是否修改，生产环境中应该关闭
         auto_reload=kw.get('auto_reload', True)
     )
+    # 字节码缓存：模板编译的结果保存在bytecode_cache_dir中(None为系统的临时目录)，重启之后不需要重新编译
+    if kw.get('bytecode_cache', False):
+        options['bytecode_cache'] = FileSystemBytecodeCache(kw.get('bytecode_cache_dir', None))
     # 获取模板文件的位置
     path = kw.get('path', None)
     if path is None:
@@ -413,6 +836,33 @@ def init__jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    # globals: 模板中可以直接使用的全局变量和函数，如static_url
+    env_globals = kw.get('globals', None)
+    if env_globals is not None:
+        env.globals.update(env_globals)
     # 所有的一切是为了给app添加__templating__字段
     # 前面将jinja2的环境配置都赋值给env了，这里再把env存入app的dict中，这样app就知道要到哪儿去找模板，怎么解析模板。
     app['__templating__'] = env
+    # 页面的ETag包含模板和静态文件的版本，部署之后客户端缓存的旧页面(可能引用已经删除的/static/dist文件)不会再得到304
+    app['__build_id__'] = build_id(path)
+    # 启动时编译所有的模板，第一次请求不需要等待编译
+    if kw.get('precompile', False):
+        precompile_templates(env)
+
+
+# 静态文件的manifest和所有模板文件的修改时间的hash，启动时计算一次
+def build_id(path):
+    h = hashlib.md5(assets.manifest_hash().encode('utf-8'))
+    for dirpath, dirnames, filenames in sorted(os.walk(path)):
+        for filename in sorted(filenames):
+            f = os.path.join(dirpath, filename)
+            h.update(('%s:%s;' % (os.path.relpath(f, path), os.path.getmtime(f))).encode('utf-8'))
+    return h.hexdigest()
+
+
+def precompile_templates(env):
+    start = time.perf_counter()
+    names = env.list_templates(extensions=('html',))
+    for name in names:
+        env.get_template(name)
+    logging.info('precompiled %s templates in %.1fms' % (len(names), (time.perf_counter() - start) * 1000))
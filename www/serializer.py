@@ -0,0 +1,99 @@
+# -*- coding: UTF-8 -*-
+"""JSON序列化：安装了orjson时使用orjson，否则使用标准库的json，输出都是utf-8编码的bytes。
+orm.Model(不包含private字段)和apis.Page可以直接序列化，很长的列表可以通过iter_dumps()分块输出。"""
+import json
+try:
+    from orm import Model, FieldSubset
+    from apis import Page
+except ImportError:
+    raise ImportError('The file is not found. Please check the file name!')
+
+# orjson是可选的
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# dict中的列表超过这个长度时，response_factory分块输出
+STREAM_THRESHOLD = 1000
+# 分块输出时每块包含的列表元素个数
+STREAM_CHUNK_SIZE = 200
+
+
+def default(o):
+    # Model的private字段不在dict中，json和orjson直接按dict序列化Model，不需要复制；
+    # 其他序列化函数把Model交给default()时，同样去掉private字段
+    if isinstance(o, Model):
+        return {k: v for k, v in dict.items(o) if k not in o.__private_fields__}
+    if isinstance(o, FieldSubset):
+        return o.serialize()
+    if isinstance(o, Page):
+        return o.__dict__
+    if isinstance(o, dict):
+        return dict(o)
+    if isinstance(o, (bytes, bytearray)):
+        return o.decode('utf-8')
+    return o.__dict__
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=default)
+
+
+SERIALIZERS = {
+    'json': _json_dumps
+}
+if orjson is not None:
+    SERIALIZERS['orjson'] = _orjson_dumps
+
+# 当前使用的序列化函数
+name = 'orjson' if orjson is not None else 'json'
+dumps = SERIALIZERS[name]
+
+
+def register(serializer_name, fn):
+    """
+    Register a serializer fn(obj) -> bytes.
+    """
+    SERIALIZERS[serializer_name] = fn
+
+
+def use(serializer_name):
+    """
+    Switch the serializer used by dumps(), 'auto' means orjson if it is installed.
+    """
+    global name, dumps
+    if serializer_name == 'auto':
+        serializer_name = 'orjson' if orjson is not None else 'json'
+    if serializer_name not in SERIALIZERS:
+        raise ValueError('Unknown serializer: %s' % serializer_name)
+    name = serializer_name
+    dumps = SERIALIZERS[serializer_name]
+
+
+# 返回dict中长度超过STREAM_THRESHOLD的列表的key，没有则返回None
+def large_list_key(obj):
+    if isinstance(obj, dict) and not isinstance(obj, Model):
+        for k, v in obj.items():
+            if isinstance(v, (list, tuple)) and len(v) > STREAM_THRESHOLD:
+                return k
+    return None
+
+
+def iter_dumps(obj, key):
+    """
+    Serialize dict obj chunk by chunk, the list obj[key] is encoded STREAM_CHUNK_SIZE items at a time.
+    """
+    rest = dict((k, v) for k, v in obj.items() if k != key)
+    head = dumps(rest)
+    # 先输出其他的字段，再输出列表
+    yield head[:-1] + (b',' if rest else b'') + dumps(key) + b':['
+    items = obj[key]
+    for n in range(0, len(items), STREAM_CHUNK_SIZE):
+        chunk = dumps(list(items[n:n + STREAM_CHUNK_SIZE]))[1:-1]
+        yield chunk if n == 0 else b',' + chunk
+    yield b']}'